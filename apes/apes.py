@@ -1,10 +1,18 @@
-import re, os, glob
-from apes.qa_system import utils, qa_module
+import re, os, sys, glob
+from apes.qa_system import utils, qa_module, profiling
+from apes import questions_store, score_cache
 import numpy as np
 import logging
 logger = logging.getLogger(__name__)
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
 import argparse
-import os, pickle, gzip
+import os, pickle, gzip, json, hashlib
+import multiprocessing
+from functools import lru_cache
+from collections import OrderedDict
 
 qa_model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model.pkl.gz' )
 
@@ -18,93 +26,653 @@ def read_pickle(file):
             data = pickle.load(f)
         return data
 
+def load_questions_mapping(path):
+    """
+        Questions store (see questions_store.py) if `path` is one, otherwise
+        the whole questions_mapping pickle.
+    """
+    with profiling.stage('load_questions_mapping'):
+        if questions_store.is_store(path):
+            return questions_store.QuestionsStore(path)
+        return read_pickle(path)
+
+def use_question_ids(questions_mapping, word_dict):
+    """
+        Let a questions store give its pre-computed question token ids if
+        they were built with the model's word_dict.
+    """
+    if isinstance(questions_mapping, questions_store.QuestionsStore) and \
+            not questions_mapping.use_word_dict(word_dict):
+        logger.warning('%s was built with another word_dict, its questions are tokenized again'
+                       % questions_mapping.path)
+
 def read_file(pred_file):
     with open(pred_file, 'r', encoding='utf-8') as f:
         summary = ''.join(f.readlines())
     return summary
 
+try:
+    from re import _compiler as _re_compiler
+except ImportError:
+    import sre_compile as _re_compiler
+try:
+    from _sre import unicode_tolower as _tolower
+except ImportError:
+    import _sre
+    def _tolower(ch):
+        return _sre.getlower(ch, re.UNICODE)
+
+# characters re.IGNORECASE takes as equal besides their lowercase, e.g. s and
+# long s; None if this Python keeps them elsewhere, then non-ASCII text is not
+# folded (see casefold)
+_EXTRA_CASES = getattr(_re_compiler, '_EXTRA_CASES', None)
+if _EXTRA_CASES is None:
+    _EXTRA_CASES = getattr(_re_compiler, '_ignorecase_fixes', None)
+
+class _CaseFold(dict):
+    """
+        str.translate table folding each character the way re.IGNORECASE
+        compares it: its simple lowercase, then the smallest equivalent one.
+    """
+
+    def __missing__(self, ch):
+        lower = _tolower(ch)
+        folded = self[ch] = chr(min((lower,) + tuple(_EXTRA_CASES.get(lower, ()))))
+        return folded
+
+_case_fold = _CaseFold()
+
+def casefold(text):
+    """
+        `text` folded so that a case-insensitive regex match of a literal is
+        a substring of it once folded as well. None for non-ASCII text when
+        the extra cases of re are not known.
+    """
+    # every ASCII character folds to its lowercase (str.isascii is Python 3.7+)
+    if max(text, default='\x00') < '\x80':
+        return text.lower()
+    if _EXTRA_CASES is None:
+        return None
+    return text.translate(_case_fold)
+
+@lru_cache(maxsize=1024)
+def entity_order(entities):
+    """
+        (ent_id, ent_name, folded name) of one article's entity mapping, from
+        the longest name to the shortest.
+        entities: tuple of (ent_id, ent_name) pairs.
+    """
+    return tuple((ent_id, ent_name, casefold(ent_name))
+                 for ent_id, ent_name in sorted(entities, key=lambda item: len(item[1]), reverse=True))
+
+@lru_cache(maxsize=8192)
+def name_pattern(ent_name):
+    return re.compile(r'\b' + re.escape(ent_name) + r'\b', flags=re.IGNORECASE)
+
 def entitize(summary, entities):
-    entitized_summary = summary
-    for ent_id, ent_name in sorted(entities.items(), key=lambda item: len(item[1]), reverse=True): 
-        entitized_summary = re.sub(r'\b' + re.escape(ent_name) + r'\b', ent_id, entitized_summary, flags=re.IGNORECASE)
+    """
+        Replace entity names in `summary` by their ids, substituting every
+        name in turn from the longest to the shortest. Word boundaries are
+        checked against the ids substituted so far, so 'St.' is left in
+        'St.@entity1'. Names missing from the folded summary are skipped
+        without a regex, only the others are compiled (and cached). Text
+        that cannot be folded (see casefold) always goes through the regex.
+    """
+    folded = casefold(summary)
+    for ent_id, ent_name, folded_name in entity_order(tuple(entities.items())):
+        if folded is not None and folded_name is not None and folded_name not in folded:
+            continue
+        entitized = name_pattern(ent_name).sub(ent_id, summary)
+        if entitized != summary:
+            summary = entitized
+            folded = casefold(summary)
+    return summary
 
-    return entitized_summary
+def entitize_loop(summary, entities):
+    """
+        One re.sub per entity name, as entitize used to do, as reference.
+    """
+    for ent_id, ent_name in sorted(entities.items(), key=lambda item: len(item[1]), reverse=True):
+        summary = re.sub(r'\b' + re.escape(ent_name) + r'\b', ent_id, summary, flags=re.IGNORECASE)
+    return summary
 
-def evaluate(prediction_filepattern, glove_path, questions_mapping_path, output_filename):
-    questions_mapping = read_pickle(questions_mapping_path)
-    scores = []
-    total_correct, total_questions = 0, 0
-    matched_summary = 0
-    total_files = 0
-    params, word_dict, entity_dict, _, test_fn, _ = qa_module.load_model(embedding_file=glove_path,
-                                                                                model_file=qa_model_path)
-    name=[]
-    nq=[]
-    nc=[]
+# (summary, mapping) pairs where a single pass over the original text
+# differs from entitize_loop: boundaries next to names ending in punctuation
+# are seen against the ids substituted before them, and characters that
+# re.IGNORECASE matches beyond their lowercase
+ENTITIZE_CASES = [
+    ('King St.Louis', {'@entity0': 'King', '@entity1': 'Louis', '@entity4': 'St.'}),
+    ('the U.S.A team', {'@entity1': 'U.S.', '@entity2': 'A'}),
+    ('Martin Luther King Jr.said', {'@entity0': 'Martin Luther King Jr.', '@entity1': 'Jr.', '@entity2': 'said'}),
+    ('St. Louis and St.Paul', {'@entity0': 'St. Louis', '@entity1': 'St.', '@entity2': 'Paul'}),
+    ('\u0130STANBUL, \u017fam and Sam', {'@entity0': 'istanbul', '@entity1': 'Sam'}),
+    ('\u017fam', {'@entity0': 'Sam'}),
+    ('\u03c3\u03b9\u03c3\u03c5\u03c6\u03bf\u03c2', {'@entity0': '\u03a3\u0399\u03a3\u03a5\u03a6\u039f\u03a3'}),
+    ('300 \u212aelvin', {'@entity0': 'kelvin', '@entity1': 'S'}),
+]
 
-    for filename in glob.glob(prediction_filepattern):
+def check_entitize(cases):
+    """
+        Number of (summary, mapping) `cases` where entitize differs from
+        entitize_loop.
+    """
+    mismatches = 0
+    for summary, mapping in cases:
+        expected, got = entitize_loop(summary, mapping), entitize(summary, mapping)
+        if expected != got:
+            mismatches += 1
+            logger.warning('entitize mismatch on %r: %r, expected %r' % (summary, got, expected))
+    return mismatches
 
+def check_entitize_files(filenames, questions_mapping):
+    """
+        check_entitize on ENTITIZE_CASES and on the summaries in `filenames`
+        with the mapping of their article.
+    """
+    cases = list(ENTITIZE_CASES)
+    for filename in filenames:
         summary_id = os.path.splitext(os.path.basename(filename))[0]
-        print(summary_id)
+        if summary_id in questions_mapping:
+            cases.append((read_file(filename), questions_mapping[summary_id]['mapping']))
+    mismatches = check_entitize(cases)
+    logger.info('entitize differs from the per-name re.sub loop on %d of %d summaries'
+                % (mismatches, len(cases)))
+    return mismatches
+
+def limit_threads(n_threads):
+    """
+        Cap BLAS / OpenMP threads, used in each worker process so that
+        workers x threads does not oversubscribe the cores.
+    """
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(n_threads)
+    if threadpool_limits is not None:
+        threadpool_limits(n_threads)
+
+def answer_summaries(summaries, questions_mapping, word_dict, entity_dict, args, test_fn, batch_size, cache=None,
+                     max_tokens=None, vocab=None):
+    """
+        Answer the questions of each (summary_id, summary) pair found in
+        `questions_mapping` from the summary. Returns (summary_id, correct)
+        for each of them, in order, where `correct` is a boolean array in the
+        order of the article's questions. Summaries found in `cache` (a
+        ScoreCache) are not vectorized nor run through the model, and
+        identical (entitized summary, questions) pairs are answered once.
+        max_tokens: batch the questions by padded tokens instead of
+        `batch_size` (see qa_module.gen_article_examples).
+        vocab: utils.Vocabulary of the dictionaries, built here if None.
+    """
+    name=[]
+    correct_of=[]
+    # summaries that contain at least one entity, answered together below
+    articles = []
+    # positions in correct_of of the summaries sharing each article
+    article_summaries = []
+    article_keys = []
+    # cache key (or content) -> position in articles
+    article_of = {}
+    # token ids of their questions when the questions store has them
+    question_ids = []
+
+    for summary_id, summary in summaries:
+
+        logger.debug(summary_id)
+        if summary_id not in questions_mapping:
+            continue
+        article = questions_mapping[summary_id]
+        with profiling.stage('entitize', examples=1):
+            entitized_summary = entitize(summary, article['mapping'])
+        questions = list(article['questions'].values())
+        curr_questions, curr_answers = zip(*[(q['question'], q['answer']) for q in questions])
+        logger.debug('%s %s', curr_questions, curr_answers)
         name.append(summary_id)
-        summary = read_file(filename)
-        total_files += 1
+        correct_of.append(np.zeros(len(curr_questions), dtype=bool))
+
+        if '@' in entitized_summary:
+            if cache is not None:
+                key = cache.key(entitized_summary, curr_questions, curr_answers)
+            else:
+                key = (entitized_summary, curr_questions, curr_answers)
+            if key in article_of:
+                article_summaries[article_of[key]].append(len(name) - 1)
+                continue
+            if cache is not None:
+                correct = cache.get(key)
+                if correct is not None:
+                    correct_of[-1][:] = correct
+                    continue
+            article_of[key] = len(articles)
+            article_summaries.append([len(name) - 1])
+            article_keys.append(key)
+            articles.append((entitized_summary, curr_questions, curr_answers))
+            question_ids.extend(q.get('question_ids') for q in questions)
+
+    # questions of all summaries go through the model in shared, length-sorted batches
+    if articles:
+        if any(ids is None for ids in question_ids):
+            question_ids = None
+        x1, x2, l, y, doc_index = utils.vectorize_articles(articles, word_dict, entity_dict, args, vocab=vocab,
+                                                           question_ids=question_ids)
+        question_correct = np.zeros(len(x2), dtype=bool)
+        for mb_x1, mb_mask1, mb_x2, mb_mask2, mb_l, mb_y, mb_doc_index, mb_questions in \
+                qa_module.gen_article_examples(x1, x2, l, y, doc_index, batch_size, max_tokens=max_tokens):
+            with profiling.stage('test_fn', examples=len(mb_y), tokens=mb_x1.size + mb_x2.size):
+                correct = qa_module.predict_articles(test_fn, mb_x1, mb_mask1, mb_x2, mb_mask2, mb_l,
+                                                     mb_doc_index) == mb_y
+            question_correct[mb_questions] = correct
+        # questions of an article are contiguous in x2
+        counts = np.bincount(doc_index, minlength=len(articles))
+        for indices, key, correct in zip(article_summaries, article_keys,
+                                         np.split(question_correct, np.cumsum(counts)[:-1])):
+            for idx in indices:
+                correct_of[idx] = correct
+            if cache is not None:
+                cache.put(key, correct)
+    if cache is not None:
+        cache.flush()
+    return list(zip(name, correct_of))
+
+def score_files(filenames, questions_mapping, word_dict, entity_dict, args, test_fn, batch_size, cache=None,
+                max_tokens=None):
+    """
+        Score the summaries in `filenames`. Returns (summary_id, num_questions,
+        num_correct) for every summary found in `questions_mapping`, in the
+        order of `filenames`.
+    """
+    summaries = []
+    for filename in filenames:
+        summary_id = os.path.splitext(os.path.basename(filename))[0]
+        if summary_id in questions_mapping:
+            summaries.append((summary_id, read_file(filename)))
+    return [(summary_id, len(correct), float(np.sum(correct)))
+            for summary_id, correct in answer_summaries(summaries, questions_mapping, word_dict, entity_dict,
+                                                        args, test_fn, batch_size, cache=cache,
+                                                        max_tokens=max_tokens)]
+
+# model and mapping loaded by evaluate, inherited copy-on-write by forked workers
+_worker_state = {}
+
+def _score_chunk(filenames):
+    # stages of this chunk only, added up by the parent
+    profiler = profiling.restart()
+    records = score_files(filenames, **_worker_state)
+    return records, profiler.stages if profiler is not None else None
+
+def iter_scores(filenames, questions_mapping, word_dict, entity_dict, args, test_fn, batch_size=32,
+                chunk_size=1000, workers=1, threads_per_worker=None, cache=None, max_tokens=None):
+    """
+        Yield (summary_id, num_questions, num_correct) for the summaries in
+        `filenames`, in order, as each chunk of `chunk_size` files is scored.
+        With workers > 1 chunks are scored by forked worker processes, each
+        with its own copy of the in-memory tier of `cache`.
+    """
+    state = dict(questions_mapping=questions_mapping, word_dict=word_dict, entity_dict=entity_dict,
+                 args=args, test_fn=test_fn, batch_size=batch_size, cache=cache, max_tokens=max_tokens)
+    if workers > 1:
+        # a few chunks per worker at least, to even out the load
+        chunk_size = max(1, min(chunk_size, -(-len(filenames) // (workers * 4))))
+    chunks = [filenames[i:i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+
+    if workers <= 1:
+        for chunk in chunks:
+            for record in score_files(chunk, **state):
+                yield record
+        return
+
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    _worker_state.update(state)
+    try:
+        with multiprocessing.get_context('fork').Pool(workers, initializer=limit_threads,
+                                                      initargs=(threads_per_worker,)) as pool:
+            for records, stages in pool.imap(_score_chunk, chunks):
+                profiling.merge(stages)
+                for record in records:
+                    yield record
+    finally:
+        _worker_state.clear()
+
+class ResultWriter(object):
+    """
+        Appends per-summary results to `output_filename` as they arrive,
+        flushing every `flush_every` rows, and the totals on `write_totals`.
+        output_format: 'csv' (the historical layout) or 'jsonl'.
+    """
+
+    def __init__(self, output_filename, output_format='csv', flush_every=100, mode='a'):
+        if output_format not in ('csv', 'jsonl'):
+            raise NotImplementedError('output_format = %s' % output_format)
+        self.output_format = output_format
+        self.flush_every = flush_every
+        self.pending = 0
+        self.f = open(output_filename, mode, encoding='utf-8')
+        if output_format == 'csv':
+            self.f.write('Summary id,num_questions ,num_correct,APES scores,\n')
+
+    def write(self, summary_id, num_questions, num_correct):
+        score = num_correct / max(num_questions, 1)
+        if self.output_format == 'csv':
+            self.f.write('\n{},{},{},{:.4f}\n'.format(summary_id, num_questions, num_correct, score))
+        else:
+            self.f.write(json.dumps({'summary_id': summary_id, 'num_questions': int(num_questions),
+                                     'num_correct': float(num_correct), 'score': float(score)}) + '\n')
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def write_totals(self, total_files, matched_summary, total_questions, apes_score, accuracy):
+        if self.output_format == 'csv':
+            self.f.write('\nSummary found,Summary Matched,Question Asked,APES scores,accuracy per question\n')
+            self.f.write('{:.4f},{},{:.4f},{},{}'.format(
+                total_files,
+                matched_summary,
+                total_questions,
+                apes_score,
+                accuracy))
+        else:
+            self.f.write(json.dumps({'total': {'summary_found': total_files, 'summary_matched': matched_summary,
+                                               'questions_asked': int(total_questions),
+                                               'apes_score': float(apes_score),
+                                               'accuracy': float(accuracy)}}) + '\n')
+        self.flush()
+
+    def flush(self):
+        self.f.flush()
+        self.pending = 0
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def run_fingerprint(args, *files):
+    """
+        Identifies the model a manifest was scored with: its options and the
+        size / mtime of the weight files.
+    """
+    key = [args.hidden_size, args.bidir, args.num_layers, args.rnn_type, args.att_func, args.num_labels]
+    for file_name in files:
+        if file_name is not None and os.path.isfile(file_name):
+            stat = os.stat(file_name)
+            key.append((os.path.abspath(file_name), stat.st_size, stat.st_mtime))
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+def content_hash(summary, article):
+    """
+        Hash of a summary together with its article's entities and questions.
+    """
+    questions = [(q['question'], q['answer']) for q in article['questions'].values()]
+    key = repr((summary, sorted(article['mapping'].items()), questions))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+class Manifest(object):
+    """
+        JSON lines record of the summaries scored into an output file:
+        a {"fingerprint": ...} header, then one line per summary with its
+        content hash and result. Entries of a different fingerprint are
+        dropped. Lines are flushed as they are added, so an interrupted run
+        keeps everything scored up to that point.
+    """
+
+    def __init__(self, path, fingerprint):
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                lines = f.readlines()
+            header = json.loads(lines[0]) if lines else {}
+            if header.get('fingerprint') == fingerprint:
+                for line in lines[1:]:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of an interrupted run
+                        break
+                    self.entries[entry['summary_id']] = entry
+
+        # rewrite without stale or duplicate lines, then keep appending
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'fingerprint': fingerprint}) + '\n')
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, path)
+        self.f = open(path, 'a', encoding='utf-8')
+
+    def get(self, summary_id, summary_hash):
+        """
+            (num_questions, num_correct) from a previous run, or None.
+        """
+        entry = self.entries.get(summary_id)
+        if entry is None or entry['hash'] != summary_hash:
+            return None
+        return entry['num_questions'], entry['num_correct']
+
+    def add(self, summary_id, summary_hash, num_questions, num_correct):
+        entry = {'summary_id': summary_id, 'hash': summary_hash,
+                 'num_questions': int(num_questions), 'num_correct': float(num_correct)}
+        self.entries[summary_id] = entry
+        self.f.write(json.dumps(entry) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def resume_scores(filenames, questions_mapping, manifest, score_fn):
+    """
+        Like iter_scores, but summaries whose content hash is in `manifest`
+        are taken from it. score_fn(filenames) scores the rest, and its
+        results are added to the manifest as they arrive.
+    """
+    hashes = {}
+    todo = []
+    for filename in filenames:
+        summary_id = os.path.splitext(os.path.basename(filename))[0]
         if summary_id not in questions_mapping:
             continue
-        entitized_summary = entitize(summary, questions_mapping[summary_id]['mapping'])
-        curr_questions, curr_answers = zip(*[(q['question'], q['answer']) for q in questions_mapping[summary_id]['questions'].values()])
-        num_questions = len(curr_questions)
-        print(curr_questions)
-        print(curr_answers)
-        nq.append(num_questions)
+        hashes[filename] = content_hash(read_file(filename), questions_mapping[summary_id])
+        if manifest.get(summary_id, hashes[filename]) is None:
+            todo.append(filename)
+    logger.info('%d of %d summaries to score, the rest is unchanged' % (len(todo), len(hashes)))
 
-        num_correct = 0
+    todo_set = set(todo)
+    scored = score_fn(todo)
+    for filename in filenames:
+        if filename not in hashes:
+            continue
+        summary_id = os.path.splitext(os.path.basename(filename))[0]
+        if filename in todo_set:
+            record = next(scored)
+            manifest.add(summary_id, hashes[filename], record[1], record[2])
+            yield record
+        else:
+            yield (summary_id,) + manifest.get(summary_id, hashes[filename])
 
-        if '@' in entitized_summary:
-            query = [[entitized_summary]*num_questions, curr_questions, curr_answers, []]
-            print(query)
-            dev_x1, dev_x2, dev_l, dev_y = utils.vectorize(query, word_dict, entity_dict, params)
-            print('vectors',dev_x1, dev_x2, dev_l, dev_y)
-            
-            all_dev = qa_module.gen_examples(dev_x1, dev_x2, dev_l, dev_y, 16)
-            dev_acc = qa_module.eval_acc(test_fn, all_dev)
-            print(all_dev,dev_acc)
-            acc = dev_acc / 100
-            num_correct = acc * num_questions
-        nc.append(num_correct)
-
-        scores.append(num_correct/num_questions)
-        total_correct += num_correct
-        total_questions += num_questions
-        matched_summary += 1
-        # with open(output_filename, 'w+') as f:
-        #     f.write('Summary id,num_questions ,num_correct,APES scores,\n')
-        #     f.write('{},{},{},{:.4f}'.format(summary_id,num_questions,num_correct,num_correct/num_questions))
-    with open(output_filename, 'a') as f:
-        f.write('Summary id,num_questions ,num_correct,APES scores,\n')
-        for i in range(len(scores)):
-             f.write('\n{},{},{},{:.4f}\n'.format(name[i],nq[i],nc[i],scores[i]))
-
-
-    with open(output_filename, 'a') as f:
-        f.write('\nSummary found,Summary Matched,Question Asked,APES scores,accuracy per question\n')
-        f.write('{:.4f},{},{:.4f},{},{}'.format(
-            total_files,
-            matched_summary, 
-            total_questions,
-            np.mean(scores),
-            (total_correct/total_questions)))
-        # f.write('Summary Matched           : {}/{}\n'.format(matched_summary, total_files))
-        # f.write('APES scores               : {:.4f}, {}/{}\n'.format(total_correct/total_questions, total_correct, total_questions))
-        # f.write('Avg accuracy per question :{:.4f} ({:.4f})'.format(np.mean(scores), np.std(scores)))
+class APESScorer(object):
+    """
+        In-process scoring, for training loops that cannot go through files:
+
+            scorer = APESScorer('questions_data.db', backend='numpy')
+            results = scorer.score([(story_id, summary_text), ...])
+
+        The model, dictionaries and questions mapping are loaded once. The
+        `article_cache_size` articles last read from a questions store are
+        kept in memory, so repeated calls on the same stories do no disk I/O.
+    """
+
+    def __init__(self, questions_mapping_path, glove_path=None, model_file=qa_model_path, backend='theano',
+                 bundle_path=None, batch_size=32, cache_size=0, max_tokens=None, article_cache_size=10000):
+        self.questions_mapping = load_questions_mapping(questions_mapping_path)
+        self.in_memory = isinstance(self.questions_mapping, dict)
+        self.articles = self.questions_mapping if self.in_memory else OrderedDict()
+        self.article_cache_size = article_cache_size
+        self.args, self.word_dict, self.entity_dict, _, self.test_fn, _ = qa_module.load_model(
+            embedding_file=glove_path, model_file=model_file, backend=backend, inference_only=True,
+            bundle_dir=bundle_path)
+        use_question_ids(self.questions_mapping, self.word_dict)
+        self.vocab = utils.Vocabulary(self.word_dict, self.entity_dict)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.cache = None
+        if cache_size > 0:
+            weights_file = os.path.join(bundle_path, 'config.json') if bundle_path else model_file
+            self.cache = score_cache.ScoreCache(run_fingerprint(self.args, weights_file), max_entries=cache_size)
+
+    def article(self, story_id):
+        if self.in_memory:
+            return self.articles.get(story_id)
+        article = self.articles.get(story_id)
+        if article is not None:
+            self.articles.move_to_end(story_id)
+            return article
+        article = self.questions_mapping.get(story_id)
+        if article is not None and self.article_cache_size > 0:
+            self.articles[story_id] = article
+            while len(self.articles) > self.article_cache_size:
+                self.articles.popitem(last=False)
+        return article
+
+    def score(self, batch):
+        """
+            batch: (story_id, summary_text) pairs, answered in shared batches.
+            Returns one dict per pair, None for stories without questions:
+                {'summary_id', 'num_questions', 'num_correct', 'score',
+                 'questions': [{'qid', 'question', 'answer', 'correct'}, ...]}
+        """
+        batch = list(batch)
+        articles = {story_id: self.article(story_id) for story_id, _ in batch}
+        articles = {story_id: article for story_id, article in articles.items() if article is not None}
+        answered = answer_summaries(batch, articles, self.word_dict, self.entity_dict, self.args,
+                                    self.test_fn, self.batch_size, cache=self.cache,
+                                    max_tokens=self.max_tokens, vocab=self.vocab)
+
+        results = []
+        answered = iter(answered)
+        for story_id, _ in batch:
+            if story_id not in articles:
+                results.append(None)
+                continue
+            _, correct = next(answered)
+            questions = [{'qid': qid, 'question': q['question'], 'answer': q['answer'], 'correct': bool(c)}
+                         for (qid, q), c in zip(articles[story_id]['questions'].items(), correct)]
+            results.append({'summary_id': story_id,
+                            'num_questions': len(correct),
+                            'num_correct': int(np.sum(correct)),
+                            'score': float(np.mean(correct)) if len(correct) else 0.0,
+                            'questions': questions})
+        return results
+
+def evaluate(prediction_filepattern, glove_path, questions_mapping_path, output_filename, backend='theano',
+             bundle_path=None, batch_size=32, workers=1, threads_per_worker=None, chunk_size=1000,
+             output_format='csv', resume=False, cache_size=0, cache_path=None, max_tokens=None):
+    """
+        resume: keep a manifest next to the output (output_filename + '.manifest')
+        and only score summaries that are new or changed since the last run
+        with the same model. The output is then rewritten with all results.
+        cache_size, cache_path: memoize results of identical (summary, article)
+        pairs in memory and / or in a SQLite file shared between runs.
+        max_tokens: batch by padded tokens instead of `batch_size` questions.
+    """
+    questions_mapping = load_questions_mapping(questions_mapping_path)
+    with profiling.stage('load_model'):
+        params, word_dict, entity_dict, _, test_fn, _ = qa_module.load_model(embedding_file=glove_path,
+                                                                                    model_file=qa_model_path,
+                                                                                    backend=backend,
+                                                                                    inference_only=True,
+                                                                                    bundle_dir=bundle_path)
+    use_question_ids(questions_mapping, word_dict)
+    filenames = sorted(glob.glob(prediction_filepattern))
+    weights_file = os.path.join(bundle_path, 'config.json') if bundle_path else qa_model_path
+
+    cache = None
+    if cache_size > 0 or cache_path is not None:
+        cache = score_cache.ScoreCache(run_fingerprint(params, weights_file), max_entries=cache_size,
+                                       path=cache_path)
+
+    def score_fn(filenames):
+        return iter_scores(filenames, questions_mapping, word_dict, entity_dict, params, test_fn,
+                           batch_size=batch_size, chunk_size=chunk_size, workers=workers,
+                           threads_per_worker=threads_per_worker, cache=cache, max_tokens=max_tokens)
+
+    manifest = None
+    if resume:
+        manifest = Manifest(output_filename + '.manifest', run_fingerprint(params, weights_file))
+        results = resume_scores(filenames, questions_mapping, manifest, score_fn)
+    else:
+        results = score_fn(filenames)
+
+    matched_summary = 0
+    total_questions, total_correct = 0, 0
+    score_sum = 0.0
+    with ResultWriter(output_filename, output_format, mode='w' if resume else 'a') as writer:
+        for summary_id, num_questions, num_correct in results:
+            writer.write(summary_id, num_questions, num_correct)
+            matched_summary += 1
+            total_questions += num_questions
+            total_correct += num_correct
+            score_sum += num_correct / max(num_questions, 1)
+        writer.write_totals(len(filenames), matched_summary, total_questions,
+                            score_sum / matched_summary if matched_summary else float('nan'),
+                            total_correct / total_questions if total_questions else float('nan'))
+    if manifest is not None:
+        manifest.close()
+    if cache is not None:
+        cache.close()
+        if workers <= 1:
+            logger.info('Score cache: %s' % cache.stats())
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='APES : summary assesment using question answering')
-    parser.add_argument('--glove_path', required=True, type=str)
+    parser.add_argument('--glove_path', default=None, type=str,
+                        help='GloVe 6B 100d embeddings, only used when there is no trained model')
     parser.add_argument('--prediction_filepattern', required=True, type=str)
     parser.add_argument('--questions_mapping_path', required=True, type=str)
-    parser.add_argument('--output_filename', required=True, type=str)
+    parser.add_argument('--output_filename', default=None, type=str,
+                        help='required unless --check_entitize')
+    parser.add_argument('--output_format', default='csv', choices=['csv', 'jsonl'])
+    parser.add_argument('--backend', default='theano', choices=['theano', 'numpy'],
+                        help='numpy runs the trained model without Theano/Lasagne')
+    parser.add_argument('--bundle_path', default=None, type=str,
+                        help='inference bundle written by apes.qa_system.bundle, replaces model.pkl.gz')
+    parser.add_argument('--batch_size', default=32, type=int,
+                        help='questions per forward pass, batches are shared across summaries')
+    parser.add_argument('--max_tokens', default=None, type=int,
+                        help='batch by padded document + question tokens instead of --batch_size')
+    parser.add_argument('--chunk_size', default=1000, type=int,
+                        help='summaries scored together, results are written after each chunk')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='worker processes, forked after the model and mapping are loaded')
+    parser.add_argument('--threads_per_worker', default=None, type=int,
+                        help='BLAS/OpenMP threads per worker, defaults to cores / workers')
+    parser.add_argument('--resume', action='store_true',
+                        help='only score new or changed summaries, see evaluate')
+    parser.add_argument('--cache_size', default=0, type=int,
+                        help='results of identical (summary, article) pairs kept in memory')
+    parser.add_argument('--cache_path', default=None, type=str,
+                        help='SQLite file caching results across runs for the same model')
+    parser.add_argument('--profile', default=None, type=str,
+                        help='write stage timings, call counts and peak memory as JSON to this file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log every summary with its questions')
+    parser.add_argument('--check_entitize', action='store_true',
+                        help='only compare entitize with the per-name re.sub loop on the summaries, '
+                             'exits with 1 if they differ')
     args = parser.parse_args()
 
-    evaluate(args.prediction_filepattern, 
-        args.glove_path, args.questions_mapping_path, args.output_filename)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(message)s', datefmt='%m-%d %H:%M')
+    if args.check_entitize:
+        sys.exit(1 if check_entitize_files(sorted(glob.glob(args.prediction_filepattern)),
+                                           load_questions_mapping(args.questions_mapping_path)) else 0)
+    if args.output_filename is None:
+        parser.error('the following arguments are required: --output_filename')
+    with profiling.session(args.profile):
+        evaluate(args.prediction_filepattern, 
+            args.glove_path, args.questions_mapping_path, args.output_filename,
+            backend=args.backend, bundle_path=args.bundle_path, batch_size=args.batch_size,
+            workers=args.workers, threads_per_worker=args.threads_per_worker,
+            chunk_size=args.chunk_size, output_format=args.output_format, resume=args.resume,
+            cache_size=args.cache_size, cache_path=args.cache_path, max_tokens=args.max_tokens)
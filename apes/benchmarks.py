@@ -0,0 +1,472 @@
+"""
+    Offline benchmarks of APES hot paths on synthetic data (no downloads).
+
+        python -m apes.benchmarks --num_examples=100000 --output=bench.json
+        python -m apes.benchmarks --benchmarks test_fn --batch_sizes 8 32 128 \
+            --doc_lens 250 750 --att_funcs bilinear mlp --output=test_fn.json
+
+    Every result is a JSON object with the benchmark name, its parameters,
+    the best time of --repeat runs and the examples / tokens per second.
+
+    A synthetic data set for end to end runs (fake GloVe file, dictionaries,
+    questions mapping, .pred summaries and an inference bundle with random
+    weights) is written with:
+
+        python -m apes.benchmarks --generate=synthetic --num_articles=1000
+        python -m apes.apes --prediction_filepattern='synthetic/preds/*.pred' \
+            --questions_mapping_path=synthetic/questions_data.pkl.gz \
+            --bundle_path=synthetic/bundle --backend=numpy --output_filename=scores.csv
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import pickle
+import hashlib
+import logging
+import argparse
+import platform
+import tempfile
+import numpy as np
+from apes import apes
+from apes.qa_system import config, utils, qa_module, np_model, bundle
+
+ATT_FUNCS = ('bilinear', 'mlp', 'dot', 'avg', 'last')
+
+
+class Args(object):
+
+    def __init__(self, num_labels, **kwargs):
+        self.num_labels = num_labels
+        self.__dict__.update(kwargs)
+
+
+def synthetic_dicts(num_words=50000, num_entities=500):
+    """
+        word_dict / entity_dict shaped like the ones of qa_module.main:
+        word ids from 2, '@entityN' markers and '<unk_entity>' in entity_dict,
+        a few entity markers missing from word_dict.
+    """
+    entities = ['@entity%d' % i for i in range(num_entities)]
+    words = entities[:num_entities - 10] + ['w%d' % i for i in range(num_words - num_entities + 10)]
+    word_dict = {w: i + 2 for i, w in enumerate(words)}
+    entity_dict = {w: i + 1 for i, w in enumerate(entities)}
+    entity_dict['<unk_entity>'] = 0
+    return word_dict, entity_dict
+
+
+def synthetic_examples(word_dict, entity_dict, num_examples=10000, doc_len=750, question_len=15,
+                       entity_rate=0.05, seed=1234):
+    """
+        (documents, questions, answers) with Zipf distributed words, about
+        `entity_rate` of them entity markers, and 1% out of vocabulary.
+    """
+    rng = np.random.RandomState(seed)
+    words = np.array([w for w in sorted(word_dict, key=word_dict.get) if w not in entity_dict] +
+                     ['oov%d' % i for i in range(1000)], dtype=object)
+    entities = np.array([e for e in entity_dict if e != '<unk_entity>'], dtype=object)
+
+    def text(length):
+        ids = np.minimum(rng.zipf(1.2, length) - 1, len(words) - 1)
+        oov = rng.rand(length) < 0.01
+        ids[oov] = len(words) - 1000 + rng.randint(1000, size=oov.sum())
+        tokens = words[ids]
+        is_entity = rng.rand(length) < entity_rate
+        tokens[is_entity] = entities[rng.randint(len(entities), size=is_entity.sum())]
+        return ' '.join(tokens)
+
+    documents = [text(max(1, int(rng.normal(doc_len, doc_len / 4)))) for _ in range(num_examples)]
+    questions = [text(question_len) for _ in range(num_examples)]
+    answers = [entities[i] for i in rng.randint(len(entities), size=num_examples)]
+    return documents, questions, answers
+
+
+def synthetic_names(num_names, rng):
+    """
+        Distinct capitalized names of one to three words.
+    """
+    syllables = np.array(['ka', 'lo', 'mi', 'ra', 'den', 'tor', 'vi', 'sa', 'nu', 'bel', 'gor', 'phi'])
+    # names ending in punctuation, whose word boundaries entitize must get right
+    affixes = np.array(['St.', 'Jr.', 'U.S.', 'Dr.', 'Co.'])
+    names = set()
+    while len(names) < num_names:
+        words = [''.join(rng.choice(syllables, rng.randint(2, 4))).capitalize()
+                 for _ in range(rng.randint(1, 4))]
+        if rng.rand() < 0.2:
+            words.append(rng.choice(affixes))
+        names.add(' '.join(words))
+    return sorted(names)
+
+
+def synthetic_articles(word_dict, num_articles=1000, summary_len=60, entities_per_article=20,
+                       questions_per_article=10, question_len=15, entity_rate=0.1, seed=1234):
+    """
+        (story_id, article, summary) triples shaped like the questions
+        mapping: article = {'mapping': {'@entity0': name, ...},
+        'questions': {'q1': {'question': ..., 'answer': '@entityN'}, ...}}.
+        The summaries mention about `entity_rate` of the names in plain text.
+    """
+    rng = np.random.RandomState(seed)
+    words = np.array([w for w in sorted(word_dict, key=word_dict.get) if not w.startswith('@')], dtype=object)
+    articles = []
+    for idx in range(num_articles):
+        story_id = hashlib.sha1(('synthetic-%d' % idx).encode('utf-8')).hexdigest()
+        markers = ['@entity%d' % i for i in range(entities_per_article)]
+        names = synthetic_names(entities_per_article, rng)
+        mapping = dict(zip(markers, names))
+
+        def text(length, entities):
+            tokens = words[np.minimum(rng.zipf(1.2, length) - 1, len(words) - 1)]
+            is_entity = rng.rand(length) < entity_rate
+            tokens[is_entity] = [entities[i] for i in rng.randint(len(entities), size=is_entity.sum())]
+            return tokens
+
+        questions = {}
+        for q in range(questions_per_article):
+            tokens = text(question_len, markers)
+            tokens[rng.randint(question_len)] = '@placeholder'
+            questions['q%d' % (q + 1)] = {'question': ' '.join(tokens),
+                                          'answer': markers[rng.randint(len(markers))]}
+        summary = ' '.join(text(summary_len, names))
+        articles.append((story_id, {'mapping': mapping, 'questions': questions}, summary))
+    return articles
+
+
+def synthetic_params(args, vocab_size, embedding_size, seed=1234):
+    """
+        Random weights in the order np_model.NumpyQAModel reads them.
+    """
+    rng = np.random.RandomState(seed)
+
+    def weight(*shape):
+        return rng.uniform(-0.1, 0.1, size=shape).astype(config._floatX)
+
+    def rnn():
+        layers = []
+        for _ in range(2 if args.bidir else 1):
+            for layer in range(args.num_layers):
+                input_size = embedding_size if layer == 0 else args.hidden_size
+                for _ in range(3):
+                    layers += [weight(input_size, args.hidden_size), weight(args.hidden_size, args.hidden_size),
+                               weight(args.hidden_size)]
+        return layers
+
+    output_size = args.hidden_size * 2 if args.bidir else args.hidden_size
+    params = [weight(vocab_size, embedding_size)] + rnn()
+    if args.att_func in ('mlp', 'bilinear', 'dot'):
+        params += rnn()
+    if args.att_func == 'mlp':
+        params += [weight(output_size, output_size), weight(output_size, output_size), weight(output_size)]
+    elif args.att_func == 'bilinear':
+        params += [weight(output_size, output_size)]
+    return params + [weight(output_size, args.num_labels), weight(args.num_labels)]
+
+
+def synthetic_model(word_dict, entity_dict, att_func='bilinear', hidden_size=128, embedding_size=100,
+                    bidir=True, num_layers=1, seed=1234):
+    args = Args(len(entity_dict), att_func=att_func, hidden_size=hidden_size, bidir=bidir,
+                num_layers=num_layers, rnn_type='gru')
+    params = synthetic_params(args, max(word_dict.values()) + 1, embedding_size, seed=seed)
+    return args, np_model.NumpyQAModel(args, params)
+
+
+def write_glove(path, word_dict, dim=100, coverage=0.9, extra_words=10000, seed=1234):
+    """
+        GloVe text file with vectors for `coverage` of `word_dict` and
+        `extra_words` words outside of it. Returns the number of lines.
+    """
+    rng = np.random.RandomState(seed)
+    words = [w for w in word_dict if rng.rand() < coverage] + ['glove%d' % i for i in range(extra_words)]
+    rng.shuffle(words)
+    with open(path, 'w', encoding='utf-8') as f:
+        for start in range(0, len(words), 10000):
+            chunk = words[start:start + 10000]
+            vectors = rng.uniform(-1, 1, size=(len(chunk), dim))
+            f.write(''.join('%s %s\n' % (w, ' '.join('%.5f' % x for x in v)) for w, v in zip(chunk, vectors)))
+    return len(words)
+
+
+def write_synthetic_data(output_dir, num_articles=1000, num_words=50000, num_entities=500, embedding_size=100,
+                         hidden_size=128, att_func='bilinear', seed=1234):
+    """
+        Write a data set apes.evaluate runs on without downloads (see the
+        module docstring). Returns the paths written.
+    """
+    os.makedirs(os.path.join(output_dir, 'preds'), exist_ok=True)
+    word_dict, entity_dict = synthetic_dicts(num_words, num_entities)
+    paths = {name: os.path.join(output_dir, name)
+             for name in ('glove.txt', 'word_dict.pkl', 'entity_dict.pkl', 'questions_data.pkl.gz', 'preds',
+                          'bundle')}
+    write_glove(paths['glove.txt'], word_dict, dim=embedding_size, seed=seed)
+    with open(paths['word_dict.pkl'], 'wb') as f:
+        pickle.dump(word_dict, f)
+    with open(paths['entity_dict.pkl'], 'wb') as f:
+        pickle.dump(entity_dict, f)
+
+    articles = synthetic_articles(word_dict, num_articles, seed=seed)
+    with gzip.open(paths['questions_data.pkl.gz'], 'wb') as f:
+        pickle.dump({story_id: article for story_id, article, _ in articles}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    for story_id, _, summary in articles:
+        with open(os.path.join(paths['preds'], story_id + '.pred'), 'w', encoding='utf-8') as f:
+            f.write(summary)
+
+    args, model = synthetic_model(word_dict, entity_dict, att_func=att_func, hidden_size=hidden_size,
+                                  embedding_size=embedding_size, seed=seed)
+    bundle.export_bundle(paths['bundle'], args, model.params, word_dict, entity_dict)
+    return paths
+
+
+def vectorize_loop(examples, word_dict, entity_dict, args):
+    """
+        The per-token dict lookups utils.vectorize used to do, as reference.
+    """
+    in_x1, in_x2, in_l, in_y = [], [], [], []
+    for d, q, a in zip(examples[0], examples[1], examples[2]):
+        d_words = d.split(' ')
+        in_x1.append([word_dict[w] if w in word_dict else 0 for w in d_words])
+        in_x2.append([word_dict[w] if w in word_dict else 0 for w in q.split(' ')])
+        in_l.append(sorted(set(entity_dict[w] for w in d_words if w in entity_dict)))
+        in_y.append(entity_dict[a] if a in entity_dict else 0)
+    order = sorted(range(len(in_x1)), key=lambda i: len(in_x1[i]))
+    return ([in_x1[i] for i in order], [in_x2[i] for i in order],
+            utils.Candidates.from_lists([in_l[i] for i in order], args.num_labels), [in_y[i] for i in order])
+
+
+def prepare_data_loop(seqs):
+    """
+        The row by row padding utils.prepare_data used to do, as reference.
+    """
+    lengths = [len(seq) for seq in seqs]
+    x = np.zeros((len(seqs), np.max(lengths))).astype('int32')
+    x_mask = np.zeros((len(seqs), np.max(lengths))).astype(config._floatX)
+    for idx, seq in enumerate(seqs):
+        x[idx, :lengths[idx]] = seq
+        x_mask[idx, :lengths[idx]] = 1.0
+    return x, x_mask
+
+
+def batches_loop(x1, x2, l, y, minibatches):
+    for minibatch in minibatches:
+        mb_x1, mb_mask1 = prepare_data_loop([x1[t] for t in minibatch])
+        mb_x2, mb_mask2 = prepare_data_loop([x2[t] for t in minibatch])
+        yield mb_x1, mb_mask1, mb_x2, mb_mask2, l.padded(minibatch), [y[t] for t in minibatch]
+
+
+def best_time(fn, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def result(benchmark, seconds, num_examples, num_tokens=0, **params):
+    """
+        One JSON result, logged as it is measured.
+    """
+    seconds = max(seconds, 1e-9)
+    record = dict(benchmark=benchmark, num_examples=num_examples, num_tokens=num_tokens, seconds=seconds,
+                  examples_per_s=num_examples / seconds, tokens_per_s=num_tokens / seconds, **params)
+    logging.info('%s %s: %.4fs, %.1f examples/s, %.2fM tokens/s' % (
+        benchmark, ' '.join('%s=%s' % item for item in sorted(params.items())), seconds,
+        num_examples / seconds, num_tokens / seconds / 1e6))
+    return record
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'floatX': config._floatX, 'argv': sys.argv}
+
+
+def consume(batches):
+    for _ in batches:
+        pass
+
+
+def bench_vectorize(num_examples=10000, doc_len=750, repeat=3):
+    word_dict, entity_dict = synthetic_dicts()
+    examples = synthetic_examples(word_dict, entity_dict, num_examples=num_examples, doc_len=doc_len)
+    args = Args(len(entity_dict))
+    num_tokens = sum(d.count(' ') + 1 for d in examples[0]) + sum(q.count(' ') + 1 for q in examples[1])
+
+    results = []
+    for name, fn in (('vectorize_loop', vectorize_loop), ('vectorize', utils.vectorize)):
+        seconds = best_time(lambda: fn(examples, word_dict, entity_dict, args), repeat=repeat)
+        results.append(result(name, seconds, num_examples, num_tokens, doc_len=doc_len))
+    return results
+
+
+def bench_batches(num_examples=10000, doc_len=750, batch_size=32, max_tokens=None, repeat=3):
+    word_dict, entity_dict = synthetic_dicts()
+    examples = synthetic_examples(word_dict, entity_dict, num_examples=num_examples, doc_len=doc_len)
+    x1, x2, l, y = utils.vectorize(examples, word_dict, entity_dict, Args(len(entity_dict)))
+    minibatches = qa_module.get_batches(x1.lengths() + x2.lengths(), batch_size, max_tokens=max_tokens,
+                                        shuffle=max_tokens is not None)
+    num_tokens = int(x1.lengths().sum() + x2.lengths().sum())
+
+    results = []
+    for name, fn in (('batches_loop', lambda: consume(batches_loop(x1, x2, l, y, minibatches))),
+                     ('iter_batches', lambda: consume(qa_module.iter_batches(x1, x2, l, y, minibatches))),
+                     ('iter_batches_buffers', lambda: consume(qa_module.iter_batches(
+                         x1, x2, l, y, minibatches, utils.BatchBuffers())))):
+        seconds = best_time(fn, repeat=repeat)
+        results.append(result(name, seconds, num_examples, num_tokens, doc_len=doc_len,
+                              batch_size=batch_size, max_tokens=max_tokens))
+    return results
+
+
+def bench_entitize(num_articles=1000, summary_len=60, entities_per_article=20, repeat=3):
+    word_dict, _ = synthetic_dicts()
+    articles = synthetic_articles(word_dict, num_articles, summary_len=summary_len,
+                                  entities_per_article=entities_per_article)
+    num_tokens = sum(summary.count(' ') + 1 for _, _, summary in articles)
+
+    mismatches = apes.check_entitize(apes.ENTITIZE_CASES +
+                                     [(summary, article['mapping']) for _, article, summary in articles])
+
+    def run(fn):
+        # every article is new to the matcher caches, as in one evaluate run
+        apes.entity_order.cache_clear()
+        apes.name_pattern.cache_clear()
+        re.purge()
+        for _, article, summary in articles:
+            fn(summary, article['mapping'])
+
+    results = []
+    for name, fn in (('entitize_loop', apes.entitize_loop), ('entitize', apes.entitize)):
+        seconds = best_time(lambda: run(fn), repeat=repeat)
+        results.append(result(name, seconds, num_articles, num_tokens, summary_len=summary_len,
+                              entities_per_article=entities_per_article, mismatches=mismatches))
+    return results
+
+
+def bench_prepare_data(doc_lens=(250, 750), batch_size=32, num_batches=100, repeat=3):
+    rng = np.random.RandomState(1234)
+    results = []
+    for doc_len in doc_lens:
+        batches = [[rng.randint(50000, size=max(1, int(n))).tolist()
+                    for n in rng.normal(doc_len, doc_len / 4, size=batch_size)] for _ in range(num_batches)]
+        num_tokens = sum(len(seq) for seqs in batches for seq in seqs)
+        for name, fn in (('prepare_data_loop', prepare_data_loop), ('prepare_data', utils.prepare_data)):
+            seconds = best_time(lambda: consume(fn(seqs) for seqs in batches), repeat=repeat)
+            results.append(result(name, seconds, batch_size * num_batches, num_tokens, doc_len=doc_len,
+                                  batch_size=batch_size))
+    return results
+
+
+def bench_gen_examples(num_examples=10000, doc_len=750, batch_sizes=(8, 32), max_tokens=32000, repeat=3):
+    word_dict, entity_dict = synthetic_dicts()
+    examples = synthetic_examples(word_dict, entity_dict, num_examples=num_examples, doc_len=doc_len)
+    x1, x2, l, y = utils.vectorize(examples, word_dict, entity_dict, Args(len(entity_dict)))
+    num_tokens = int(x1.lengths().sum() + x2.lengths().sum())
+    results = []
+    for batch_size, tokens in [(b, None) for b in batch_sizes] + [(None, max_tokens)]:
+        seconds = best_time(lambda: qa_module.gen_examples(x1, x2, l, y, batch_size, max_tokens=tokens),
+                            repeat=repeat)
+        results.append(result('gen_examples', seconds, num_examples, num_tokens, doc_len=doc_len,
+                              batch_size=batch_size, max_tokens=tokens))
+    return results
+
+
+def bench_gen_embeddings(num_words=50000, embedding_size=100, repeat=3):
+    word_dict, _ = synthetic_dicts(num_words)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'glove.txt')
+        num_lines = write_glove(path, word_dict, dim=embedding_size)
+        seconds = best_time(lambda: utils.gen_embeddings(word_dict, embedding_size, path, init=utils.uniform_init),
+                            repeat=repeat)
+    return [result('gen_embeddings', seconds, num_lines, num_lines * (embedding_size + 1),
+                   num_words=num_words, embedding_size=embedding_size)]
+
+
+def bench_test_fn(batch_sizes=(8, 32), doc_lens=(250, 750), att_funcs=ATT_FUNCS, num_batches=2, hidden_size=128,
+                  embedding_size=100, repeat=3):
+    """
+        test_fn throughput of the numpy model with random weights on
+        `num_batches` batches of each size.
+    """
+    word_dict, entity_dict = synthetic_dicts()
+    results = []
+    for att_func in att_funcs:
+        _, test_fn = synthetic_model(word_dict, entity_dict, att_func=att_func, hidden_size=hidden_size,
+                                     embedding_size=embedding_size)
+        for doc_len in doc_lens:
+            examples = synthetic_examples(word_dict, entity_dict, num_examples=max(batch_sizes) * num_batches,
+                                          doc_len=doc_len)
+            x1, x2, l, y = utils.vectorize(examples, word_dict, entity_dict, Args(len(entity_dict)),
+                                           sort_by_len=False)
+            for batch_size in batch_sizes:
+                n = batch_size * num_batches
+                batches = qa_module.gen_examples(x1.take(np.arange(n)), x2.take(np.arange(n)),
+                                                 l.take(np.arange(n)), y[:n], batch_size)
+                num_tokens = int(sum(mb_x1.size + mb_x2.size for mb_x1, _, mb_x2, _, _, _ in batches))
+                seconds = best_time(lambda: qa_module.eval_acc(test_fn, batches), repeat=repeat)
+                results.append(result('test_fn', seconds, n, num_tokens, att_func=att_func, doc_len=doc_len,
+                                      batch_size=batch_size, hidden_size=hidden_size))
+    return results
+
+
+BENCHMARKS = ('vectorize', 'batches', 'entitize', 'prepare_data', 'gen_examples', 'gen_embeddings', 'test_fn')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark APES hot paths on synthetic data')
+    parser.add_argument('--num_examples', type=int, default=10000)
+    parser.add_argument('--doc_len', type=int, default=750,
+                        help='mean document length in tokens')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--max_tokens', type=int, default=32000,
+                        help='token budget of the length bucketed batches')
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=list(BENCHMARKS), choices=BENCHMARKS)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 32],
+                        help='batch sizes of gen_examples and test_fn')
+    parser.add_argument('--doc_lens', type=int, nargs='+', default=[250, 750],
+                        help='mean document lengths of prepare_data and test_fn')
+    parser.add_argument('--att_funcs', type=str, nargs='+', default=list(ATT_FUNCS), choices=ATT_FUNCS)
+    parser.add_argument('--test_fn_batches', type=int, default=2,
+                        help='batches per test_fn measurement')
+    parser.add_argument('--hidden_size', type=int, default=128)
+    parser.add_argument('--embedding_size', type=int, default=100)
+    parser.add_argument('--num_articles', type=int, default=1000,
+                        help='summaries of the entitize benchmark and of --generate')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', type=str, default=None,
+                        help='write the results as JSON')
+    parser.add_argument('--generate', type=str, default=None,
+                        help='only write a synthetic data set to this directory')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%m-%d %H:%M')
+    if args.generate is not None:
+        paths = write_synthetic_data(args.generate, args.num_articles, embedding_size=args.embedding_size,
+                                     hidden_size=args.hidden_size)
+        for name, path in sorted(paths.items()):
+            logging.info('%s: %s' % (name, path))
+        sys.exit(0)
+
+    results = []
+    if 'vectorize' in args.benchmarks:
+        results += bench_vectorize(args.num_examples, args.doc_len, args.repeat)
+    if 'batches' in args.benchmarks:
+        results += bench_batches(args.num_examples, args.doc_len, args.batch_size, repeat=args.repeat)
+        results += bench_batches(args.num_examples, args.doc_len, args.batch_size, max_tokens=args.max_tokens,
+                                 repeat=args.repeat)
+    if 'entitize' in args.benchmarks:
+        results += bench_entitize(args.num_articles, repeat=args.repeat)
+    if 'prepare_data' in args.benchmarks:
+        results += bench_prepare_data(args.doc_lens, args.batch_size, repeat=args.repeat)
+    if 'gen_examples' in args.benchmarks:
+        results += bench_gen_examples(args.num_examples, args.doc_len, args.batch_sizes, args.max_tokens,
+                                      repeat=args.repeat)
+    if 'gen_embeddings' in args.benchmarks:
+        results += bench_gen_embeddings(embedding_size=args.embedding_size, repeat=args.repeat)
+    if 'test_fn' in args.benchmarks:
+        results += bench_test_fn(args.batch_sizes, args.doc_lens, args.att_funcs, args.test_fn_batches,
+                                 args.hidden_size, args.embedding_size, repeat=args.repeat)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
@@ -0,0 +1,133 @@
+"""
+    Build the questions mapping used by apes.evaluate from the CNN / Daily
+    Mail question archives:
+
+        story id -> {'mapping': {'@entity0': 'name', ...},
+                     'questions': {'q1': {'question': ..., 'answer': ...}, ...}}
+
+    The story id is the sha1 of the article url, as in the .story files.
+    The archives are streamed, batches of .question files are parsed by a
+    process pool and grouped by article, and each batch is appended to a
+    questions store (see questions_store.py) so memory does not grow with
+    the corpus. Running it again with more archives extends the store.
+    Every .question file numbers its entity markers on its own, the store
+    renumbers them by entity name onto one mapping per article.
+
+        python -m apes.create_questions_mapping --cnn_questions_path=cnn.tgz \
+            --dm_questions_path=dailymail.tgz --output=questions_data.db
+
+    An --output ending in .pkl.gz is exported as the historical pickle.
+"""
+import os
+import gzip
+import pickle
+import hashlib
+import logging
+import argparse
+import multiprocessing
+from collections import deque, OrderedDict
+from apes import questions_store
+from apes.qa_system import prep
+
+
+def parse_article_questions(contents):
+    """
+        (story_id, [(question, answer, mapping), ...]) of the .question files
+        `contents` (bytes), grouped by article in order of appearance. Each
+        question comes with the entity mapping of its own file.
+    """
+    groups = OrderedDict()
+    for data in contents:
+        lines = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        if len(lines) < 7:
+            continue
+        story_id = hashlib.sha1(lines[0].strip().encode('utf-8')).hexdigest()
+        mapping = {}
+        for line in lines[8:]:
+            marker, sep, name = line.partition(':')
+            if sep:
+                mapping[marker] = name
+        groups.setdefault(story_id, []).append((lines[4], lines[6], mapping))
+    return list(groups.items())
+
+
+def build_questions_mapping(archives, output, word_dict, splits=prep.SPLITS, batch_size=10000, workers=None):
+    """
+        Append the questions of `archives` to the questions store `output`.
+        Returns the number of questions added.
+    """
+    workers = workers or os.cpu_count() or 1
+    num_questions = 0
+    pending = deque()
+    with questions_store.QuestionsStore(output, word_dict) as store:
+        def wait(max_pending):
+            nonlocal num_questions
+            while len(pending) > max_pending:
+                num_questions += store.extend_many(pending.popleft().get())
+                logging.info('%d questions, %d articles' % (num_questions, len(store)))
+
+        with multiprocessing.Pool(workers) as pool:
+            for archive in archives:
+                contents = []
+                for _, _, data in prep.iter_archive(archive, splits):
+                    contents.append(data)
+                    if len(contents) >= batch_size:
+                        pending.append(pool.apply_async(parse_article_questions, (contents,)))
+                        contents = []
+                        # bounds the file contents held in memory
+                        wait(2 * workers)
+                if contents:
+                    pending.append(pool.apply_async(parse_article_questions, (contents,)))
+            wait(0)
+    return num_questions
+
+
+def export_pickle(store_path, output):
+    """
+        Write the store as the questions_mapping pickle (gzipped if `output`
+        ends with .gz). The whole mapping is held in memory for this.
+    """
+    with questions_store.QuestionsStore(store_path) as store:
+        questions_mapping = {}
+        for story_id in list(store):
+            article = store[story_id]
+            questions_mapping[story_id] = {
+                'mapping': article['mapping'],
+                'questions': {qid: {'question': q['question'], 'answer': q['answer']}
+                              for qid, q in article['questions'].items()}}
+    open_fn = gzip.open if output.endswith('.gz') else open
+    with open_fn(output, 'wb') as f:
+        pickle.dump(questions_mapping, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return len(questions_mapping)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the questions mapping from the CNN / Daily Mail archives')
+    parser.add_argument('--cnn_questions_path', type=str, default=None)
+    parser.add_argument('--dm_questions_path', type=str, default=None)
+    parser.add_argument('--output', type=str, default='questions_data.db',
+                        help='questions store to create or extend, or a .pkl / .pkl.gz to export')
+    parser.add_argument('--word_dict', type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'qa_system', 'word_dict.pkl'))
+    parser.add_argument('--splits', type=str, nargs='+', default=list(prep.SPLITS))
+    parser.add_argument('--batch_size', type=int, default=10000,
+                        help='.question files per task')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='parsing processes, default: one per cpu')
+    args = parser.parse_args()
+
+    archives = [path for path in (args.cnn_questions_path, args.dm_questions_path) if path is not None]
+    if not archives:
+        parser.error('at least one of --cnn_questions_path and --dm_questions_path is required')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%m-%d %H:%M')
+    with open(args.word_dict, 'rb') as f:
+        word_dict = pickle.load(f)
+
+    export = args.output.endswith('.pkl') or args.output.endswith('.pkl.gz')
+    store_path = args.output + '.db' if export else args.output
+    n = build_questions_mapping(archives, store_path, word_dict, splits=args.splits,
+                                batch_size=args.batch_size, workers=args.workers)
+    logging.info('Added %d questions to %s' % (n, store_path))
+    if export:
+        logging.info('Exported %d articles to %s' % (export_pickle(store_path, args.output), args.output))
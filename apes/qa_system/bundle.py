@@ -0,0 +1,105 @@
+"""
+    Self-contained inference bundle: one directory with the trained weights
+    (embedding matrix included), word_dict and entity_dict stored as
+    uncompressed .npy files. Weights are memory-mapped on load, so nothing is
+    unpickled or decompressed and no embedding file is needed to score.
+
+        bundle/
+            config.json
+            param_000.npy ...               lasagne.layers.get_all_params order
+            word_bytes.npy, word_offsets.npy, word_ids.npy
+            entity_bytes.npy, entity_offsets.npy, entity_ids.npy
+
+    Export from a checkpoint with:
+        python -m apes.qa_system.bundle --model_file=model.pkl.gz --output_dir=apes_bundle
+"""
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+from apes.qa_system import config, utils, np_model
+
+CONFIG_FILE = 'config.json'
+
+# model options needed to rebuild the network, see qa_module.checkpoint_args
+MODEL_CONFIG = ('hidden_size', 'bidir', 'num_layers', 'rnn_type', 'att_func')
+
+
+def _save_dict(bundle_dir, name, dic):
+    keys = list(dic.keys())
+    encoded = [k.encode('utf-8') for k in keys]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(k) for k in encoded])
+    np.save(os.path.join(bundle_dir, name + '_bytes.npy'),
+            np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(os.path.join(bundle_dir, name + '_offsets.npy'), offsets)
+    np.save(os.path.join(bundle_dir, name + '_ids.npy'),
+            np.array([dic[k] for k in keys], dtype=np.int32))
+
+
+def _load_dict(bundle_dir, name):
+    blob = np.load(os.path.join(bundle_dir, name + '_bytes.npy')).tobytes()
+    offsets = np.load(os.path.join(bundle_dir, name + '_offsets.npy')).tolist()
+    ids = np.load(os.path.join(bundle_dir, name + '_ids.npy')).tolist()
+    return {blob[offsets[i]:offsets[i + 1]].decode('utf-8'): ids[i] for i in range(len(ids))}
+
+
+def export_bundle(bundle_dir, args, param_values, word_dict, entity_dict):
+    """
+        Write `param_values` (as saved by utils.save_params) and the
+        dictionaries to `bundle_dir`.
+    """
+    args.num_labels = param_values[-1].shape[0]
+    # fails early if the parameters do not match the model options
+    np_model.NumpyQAModel(args, param_values)
+
+    os.makedirs(bundle_dir, exist_ok=True)
+    for idx, value in enumerate(param_values):
+        np.save(os.path.join(bundle_dir, 'param_%03d.npy' % idx), np.ascontiguousarray(value))
+    _save_dict(bundle_dir, 'word', word_dict)
+    _save_dict(bundle_dir, 'entity', entity_dict)
+
+    model_config = {k: getattr(args, k) for k in MODEL_CONFIG}
+    model_config['num_labels'] = args.num_labels
+    model_config['num_params'] = len(param_values)
+    with open(os.path.join(bundle_dir, CONFIG_FILE), 'w') as f:
+        json.dump(model_config, f, indent=2)
+
+
+def load_bundle(bundle_dir, mmap_mode='r'):
+    """
+        Returns config, param_values, word_dict, entity_dict.
+    """
+    with open(os.path.join(bundle_dir, CONFIG_FILE)) as f:
+        model_config = json.load(f)
+    param_values = [np.load(os.path.join(bundle_dir, 'param_%03d.npy' % idx), mmap_mode=mmap_mode)
+                    for idx in range(model_config['num_params'])]
+    word_dict = _load_dict(bundle_dir, 'word')
+    entity_dict = _load_dict(bundle_dir, 'entity')
+    return model_config, param_values, word_dict, entity_dict
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a trained QA model as an inference bundle')
+    parser.add_argument('--model_file', type=str, required=True,
+                        help='checkpoint written by utils.save_params (model.pkl.gz)')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--entity_dict', type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'entity_dict.pkl'))
+    parser.add_argument('--word_dict', type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'word_dict.pkl'))
+    parser.add_argument('--hidden_size', type=int, default=128)
+    parser.add_argument('--bidir', type=config.str2bool, default=True)
+    parser.add_argument('--num_layers', type=int, default=1)
+    parser.add_argument('--rnn_type', type=str, default='gru')
+    parser.add_argument('--att_func', type=str, default='bilinear')
+    args = parser.parse_args()
+
+    with open(args.entity_dict, 'rb') as f:
+        entity_dict = pickle.load(f)
+    with open(args.word_dict, 'rb') as f:
+        word_dict = pickle.load(f)
+    param_values = utils.checkpoint_values(utils.load_params(args.model_file))
+    export_bundle(args.output_dir, args, param_values, word_dict, entity_dict)
+    print('Wrote %d parameter arrays to %s' % (len(param_values), args.output_dir))
@@ -1,9 +1,13 @@
 
-import theano
 import argparse
 
-
-_floatX = theano.config.floatX
+try:
+    import theano
+    _floatX = theano.config.floatX
+except ImportError:
+    # inference through np_model does not need Theano, keep its default floatX
+    theano = None
+    _floatX = 'float64'
 
 
 def str2bool(v):
@@ -46,6 +50,11 @@ def get_args():
                         default=None,
                         help='Development file')
 
+    parser.add_argument('--corpus_dir',
+                        type=str,
+                        default=None,
+                        help='Pre-tokenized corpus (see corpus.py), replaces train_file and dev_file')
+
     parser.add_argument('--pre_trained',
                         type=str,
                         default=None,
@@ -113,6 +122,34 @@ def get_args():
                         default=32,
                         help='Batch size')
 
+    parser.add_argument('--max_tokens',
+                        type=int,
+                        default=None,
+                        help='Size batches by padded document + question tokens instead of batch_size, '
+                             '0 picks the fastest budget for this machine')
+
+    parser.add_argument('--stream_buffer',
+                        type=int,
+                        default=None,
+                        help='Stream the training file, vectorizing this many examples at a time, '
+                             'instead of loading it all in memory')
+
+    parser.add_argument('--prefetch',
+                        type=int,
+                        default=2,
+                        help='Training batches built ahead by a background thread, 0 builds them in the loop')
+
+    parser.add_argument('--prefetch_processes',
+                        type='bool',
+                        default=False,
+                        help='Build the prefetched batches in a forked process instead of a thread, '
+                             'for a train_fn that holds the GIL')
+
+    parser.add_argument('--profile',
+                        type=str,
+                        default=None,
+                        help='Write stage timings, call counts and peak memory as JSON to this file')
+
     parser.add_argument('--num_epoches',
                         type=int,
                         default=100,
@@ -0,0 +1,211 @@
+"""
+    Pre-tokenized training / dev / test sets. Each split is a directory of
+    flat arrays in CSR layout, memory-mapped on load, so no text is parsed
+    and no Python lists of ids are built:
+
+        corpus/
+            word_dict.pkl, entity_dict.pkl     built from the training file
+            train/ dev/ test/
+                corpus.json                    array sizes
+                doc_tokens.bin (int32), doc_offsets.bin (int64)
+                question_tokens.bin, question_offsets.bin
+                answers.bin (int32)             entity id of each answer
+                candidates.bin (int32), candidate_offsets.bin
+                                                entity ids in each document
+
+    Token ids are those of utils.vectorize (0 for unknown words). Build once
+    with:
+        python -m apes.qa_system.corpus --train_file=train.txt --dev_file=dev.txt \
+            --test_file=test.txt --output_dir=corpus
+    and train with --corpus_dir=corpus.
+"""
+import os
+import json
+import pickle
+import argparse
+import itertools
+import numpy as np
+from apes.qa_system import config, utils
+
+META_FILE = 'corpus.json'
+
+# name: dtype
+ARRAYS = {'doc_tokens': np.int32, 'doc_offsets': np.int64,
+          'question_tokens': np.int32, 'question_offsets': np.int64,
+          'answers': np.int32,
+          'candidates': np.int32, 'candidate_offsets': np.int64}
+
+
+def write_corpus(split_dir, examples, word_dict, entity_dict, chunk_size=1000):
+    """
+        Encode (document, question, answer) triples into `split_dir`,
+        `chunk_size` examples at a time. Returns the number of examples.
+    """
+    os.makedirs(split_dir, exist_ok=True)
+    files = {name: open(os.path.join(split_dir, name + '.bin'), 'wb') for name in ARRAYS}
+    sizes = {'doc_tokens': 0, 'question_tokens': 0, 'candidates': 0}
+    num_examples = 0
+    try:
+        for name in ('doc_offsets', 'question_offsets', 'candidate_offsets'):
+            np.zeros(1, dtype=ARRAYS[name]).tofile(files[name])
+        vocab = utils.Vocabulary(word_dict, entity_dict)
+        examples = iter(examples)
+        while True:
+            chunk = list(itertools.islice(examples, chunk_size))
+            if not chunk:
+                break
+            documents, questions, answers = zip(*chunk)
+            d_codes, d_offsets = vocab.encode(documents)
+            q_codes, q_offsets = vocab.encode(questions)
+            candidates = vocab.candidates(d_codes, d_offsets, len(entity_dict))
+            for name, offsets_name, values, offsets in (
+                    ('doc_tokens', 'doc_offsets', vocab.token_ids(d_codes), d_offsets),
+                    ('question_tokens', 'question_offsets', vocab.token_ids(q_codes), q_offsets),
+                    ('candidates', 'candidate_offsets', candidates.ids, candidates.offsets)):
+                values.astype(ARRAYS[name]).tofile(files[name])
+                (sizes[name] + offsets[1:]).astype(ARRAYS[offsets_name]).tofile(files[offsets_name])
+                sizes[name] += int(offsets[-1])
+            np.array([entity_dict[a] if a in entity_dict else 0 for a in answers],
+                     dtype=ARRAYS['answers']).tofile(files['answers'])
+            num_examples += len(chunk)
+    finally:
+        for f in files.values():
+            f.close()
+
+    meta = dict(sizes, num_examples=num_examples)
+    with open(os.path.join(split_dir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return num_examples
+
+
+def _load_array(split_dir, name, size, mmap):
+    if size == 0:
+        return np.zeros(0, dtype=ARRAYS[name])
+    path = os.path.join(split_dir, name + '.bin')
+    if mmap:
+        return np.memmap(path, dtype=ARRAYS[name], mode='r', shape=(size,))
+    return np.fromfile(path, dtype=ARRAYS[name], count=size)
+
+
+class Corpus(object):
+    """
+        One split written by write_corpus.
+    """
+
+    def __init__(self, split_dir, mmap=True):
+        with open(os.path.join(split_dir, META_FILE)) as f:
+            meta = json.load(f)
+        n = meta['num_examples']
+        sizes = {'doc_tokens': meta['doc_tokens'], 'question_tokens': meta['question_tokens'],
+                 'candidates': meta['candidates'], 'answers': n,
+                 'doc_offsets': n + 1, 'question_offsets': n + 1, 'candidate_offsets': n + 1}
+        for name in ARRAYS:
+            setattr(self, name, _load_array(split_dir, name, sizes[name], mmap))
+
+    def __len__(self):
+        return len(self.answers)
+
+    def document(self, i):
+        return self.doc_tokens[self.doc_offsets[i]:self.doc_offsets[i + 1]]
+
+    def question(self, i):
+        return self.question_tokens[self.question_offsets[i]:self.question_offsets[i + 1]]
+
+    def candidates_of(self, i):
+        return self.candidates[self.candidate_offsets[i]:self.candidate_offsets[i + 1]]
+
+    def documents(self):
+        """
+            The documents as utils.Sequences, without copying.
+        """
+        return utils.Sequences(self.doc_tokens, self.doc_offsets)
+
+    def questions(self):
+        return utils.Sequences(self.question_tokens, self.question_offsets)
+
+    def doc_lengths(self):
+        return np.diff(self.doc_offsets)
+
+    def question_lengths(self):
+        return np.diff(self.question_offsets)
+
+    def labels(self, num_labels):
+        """
+            The candidates as utils.Candidates, without copying.
+        """
+        return utils.Candidates(self.candidates, self.candidate_offsets, num_labels)
+
+    def candidate_mask(self, indices, num_labels):
+        """
+            Dense in_l rows of `indices`.
+        """
+        return self.labels(num_labels).mask(indices)
+
+    def vectorize(self, num_labels, max_example=None):
+        """
+            Same output as utils.vectorize on the first `max_example`
+            examples, in memory (dev, test).
+        """
+        n = len(self) if max_example is None else min(len(self), max_example)
+        order = np.argsort(self.doc_lengths()[:n], kind='stable')
+        in_x1 = self.documents().take(order)
+        in_x2 = self.questions().take(order)
+        in_l = self.labels(num_labels).take(order)
+        in_y = self.answers[order].tolist()
+        return in_x1, in_x2, in_l, in_y
+
+
+def load_dicts(corpus_dir):
+    with open(os.path.join(corpus_dir, 'word_dict.pkl'), 'rb') as f:
+        word_dict = pickle.load(f)
+    with open(os.path.join(corpus_dir, 'entity_dict.pkl'), 'rb') as f:
+        entity_dict = pickle.load(f)
+    return word_dict, entity_dict
+
+
+def build_corpus(output_dir, train_file, dev_file=None, test_file=None, relabeling=True, max_words=50000):
+    """
+        Build word_dict / entity_dict from `train_file` as qa_module.main
+        does, then encode each split. The text files are streamed.
+    """
+    questions = []
+    answers = []
+
+    def documents():
+        for document, question, answer in utils.iter_examples(train_file, relabeling=relabeling):
+            questions.append(question)
+            answers.append(answer)
+            yield document
+    # documents first, then questions, the order main passes them to build_dict
+    word_dict = utils.build_dict(itertools.chain(documents(), questions), max_words=max_words)
+    entity_dict = utils.build_entity_dict(word_dict, answers)
+    del questions[:], answers[:]
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'word_dict.pkl'), 'wb') as f:
+        pickle.dump(word_dict, f)
+    with open(os.path.join(output_dir, 'entity_dict.pkl'), 'wb') as f:
+        pickle.dump(entity_dict, f)
+
+    counts = {}
+    for split, in_file in (('train', train_file), ('dev', dev_file), ('test', test_file)):
+        if in_file is not None:
+            counts[split] = write_corpus(os.path.join(output_dir, split),
+                                         utils.iter_examples(in_file, relabeling=relabeling),
+                                         word_dict, entity_dict)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-tokenize CNN / Daily Mail text files')
+    parser.add_argument('--train_file', type=str, required=True)
+    parser.add_argument('--dev_file', type=str, default=None)
+    parser.add_argument('--test_file', type=str, default=None)
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--relabeling', type=config.str2bool, default=True)
+    args = parser.parse_args()
+
+    counts = build_corpus(args.output_dir, args.train_file, args.dev_file, args.test_file,
+                          relabeling=args.relabeling)
+    for split, n in counts.items():
+        print('%s: %d examples' % (split, n))
@@ -21,7 +21,7 @@ def gen_examples(x1, x2, l, y, batch_size):
     for minibatch in minibatches:
         mb_x1 = [x1[t] for t in minibatch]
         mb_x2 = [x2[t] for t in minibatch]
-        mb_l = l[minibatch]
+        mb_l = l.mask(minibatch)
         mb_y = [y[t] for t in minibatch]
         mb_x1, mb_mask1 = utils.prepare_data(mb_x1)
         mb_x2, mb_mask2 = utils.prepare_data(mb_x2)
@@ -217,7 +217,7 @@ def main(args):
                                                   replace=False))
                 sample_train = gen_examples([train_x1[k] for k in samples],
                                             [train_x2[k] for k in samples],
-                                            train_l[samples],
+                                            train_l.take(samples),
                                             [train_y[k] for k in samples],
                                             args.batch_size)
                 logging.info('Train accuracy: %.2f %%' % eval_acc(test_fn, sample_train))
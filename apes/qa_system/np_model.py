@@ -0,0 +1,307 @@
+"""
+    Pure NumPy forward pass of the network built by qa_module.build_fn.
+
+    The parameters are read in the order of
+    lasagne.layers.get_all_params(network, trainable=True), which is also the
+    order `utils.save_params` writes them to model.pkl.gz:
+
+        embedding W
+        document rnn (backwards), document rnn (forwards)     # per layer
+        question rnn (backwards), question rnn (forwards)     # mlp/bilinear/dot only
+        attention params
+        dense W, dense b
+"""
+import logging
+import numpy as np
+from apes.qa_system import utils
+
+# W_in_to_*, W_hid_to_*, b_* for updategate, resetgate and hidden_update
+GRU_PARAMS = 9
+
+ATT_PARAMS = {'mlp': 3, 'bilinear': 1, 'avg': 0, 'last': 0, 'dot': 0}
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def gru(x, mask, params, backwards=False, only_return_final=False):
+    """
+        Deterministic lasagne.layers.GRULayer with mask_input and a zero hid_init.
+        x: batch x len x d
+        mask: batch x len
+        params: updategate, resetgate, hidden_update (W_in, W_hid, b) as stored.
+    """
+    (W_in_u, W_hid_u, b_u,
+     W_in_r, W_hid_r, b_r,
+     W_in_c, W_hid_c, b_c) = params
+    n_samples, max_len = mask.shape
+    num_units = W_hid_u.shape[0]
+
+    # same stacking as lasagne: resetgate, updategate, hidden_update
+    W_in = np.concatenate([W_in_r, W_in_u, W_in_c], axis=1)
+    W_hid = np.concatenate([W_hid_r, W_hid_u, W_hid_c], axis=1)
+    b = np.concatenate([b_r, b_u, b_c])
+    inputs = np.dot(x, W_in) + b
+
+    hid = np.zeros((n_samples, num_units), dtype=inputs.dtype)
+    if not only_return_final:
+        hid_out = np.empty((n_samples, max_len, num_units), dtype=inputs.dtype)
+    steps = range(max_len - 1, -1, -1) if backwards else range(max_len)
+    for t in steps:
+        input_n = inputs[:, t]
+        hid_input = np.dot(hid, W_hid)
+        resetgate = sigmoid(hid_input[:, :num_units] + input_n[:, :num_units])
+        updategate = sigmoid(hid_input[:, num_units:2 * num_units] +
+                             input_n[:, num_units:2 * num_units])
+        hidden_update = np.tanh(input_n[:, 2 * num_units:] +
+                                resetgate * hid_input[:, 2 * num_units:])
+        new_hid = (1 - updategate) * hid + updategate * hidden_update
+        mask_n = mask[:, t, None]
+        hid = new_hid * mask_n + hid * (1 - mask_n)
+        if not only_return_final:
+            hid_out[:, t] = hid
+    return hid if only_return_final else hid_out
+
+
+def stack_rnn(x, mask, layers, only_return_final=False):
+    """
+        Mirror of nn_layers.stack_rnn.
+        layers: [backwards layer params, forwards layer params (if bidir)],
+                each a list with one entry per stacked layer.
+    """
+    def _rnn(layer_params, backwards):
+        network = x
+        for layer, params in enumerate(layer_params):
+            c_only_return_final = only_return_final and (layer == len(layer_params) - 1)
+            network = gru(network, mask, params, backwards=backwards,
+                          only_return_final=c_only_return_final)
+        return network
+
+    outputs = [_rnn(layers[0], True)]
+    if len(layers) > 1:
+        outputs.append(_rnn(layers[1], False))
+    return np.concatenate(outputs, axis=-1)
+
+
+def _renormalize(alpha, mask):
+    alpha = alpha * mask
+    return alpha / alpha.sum(axis=1, keepdims=True)
+
+
+def average_pooling(d, mask):
+    return (d * mask[:, :, None]).sum(axis=1) / mask.sum(axis=1, keepdims=True)
+
+
+def _weighted_sum(d, alpha):
+    # batch x len x h, batch x len -> batch x h
+    return np.matmul(alpha[:, None, :], d)[:, 0, :]
+
+
+def mlp_attention(d, q, mask, W0, W1, Wb):
+    M = np.tanh(np.dot(d, W0) + np.dot(q, W1)[:, None, :])
+    alpha = _renormalize(softmax(np.dot(M, Wb)), mask)
+    return _weighted_sum(d, alpha)
+
+
+def bilinear_attention(d, q, mask, W):
+    M = np.dot(q, W)
+    alpha = _renormalize(softmax(np.matmul(d, M[:, :, None])[:, :, 0]), mask)
+    return _weighted_sum(d, alpha)
+
+
+def dot_attention(d, q, mask):
+    alpha = _renormalize(softmax(np.matmul(d, q[:, :, None])[:, :, 0]), mask)
+    return _weighted_sum(d, alpha)
+
+
+class NumpyQAModel(object):
+    """
+        Inference-only model that can stand in for the `test_fn` returned by
+        qa_module.build_fn: calling it with (x1, mask1, x2, mask2, l, y)
+        returns the number of correct answers in the batch. As in build_fn,
+        only the output columns of the candidates in `l` are evaluated.
+    """
+
+    def __init__(self, args, param_values):
+        if args.rnn_type != 'gru':
+            raise NotImplementedError('rnn_type = %s' % args.rnn_type)
+        if args.att_func not in ATT_PARAMS:
+            raise NotImplementedError('att_func = %s' % args.att_func)
+        self.att_func = args.att_func
+        self.params = [np.asarray(p) for p in param_values]
+
+        values = iter(self.params)
+
+        def take(n):
+            return [next(values) for _ in range(n)]
+
+        def take_rnn():
+            directions = 2 if args.bidir else 1
+            return [[take(GRU_PARAMS) for _ in range(args.num_layers)]
+                    for _ in range(directions)]
+
+        self.W_emb, = take(1)
+        self.doc_rnn = take_rnn()
+        self.question_rnn = take_rnn() if self.uses_question else None
+        self.att_params = take(ATT_PARAMS[self.att_func])
+        self.W_out, self.b_out = take(2)
+        if next(values, None) is not None:
+            raise ValueError('checkpoint has more parameters than the model config expects')
+        logging.debug('#params: %d' % sum(p.size for p in self.params))
+
+    @classmethod
+    def from_checkpoint(cls, args, model_file):
+        return cls(args, utils.checkpoint_values(utils.load_params(model_file)))
+
+    @property
+    def uses_question(self):
+        return self.att_func in ('mlp', 'bilinear', 'dot')
+
+    def encode_documents(self, x1, mask1):
+        """
+            Document states: batch x len x h (batch x h when att_func is 'last').
+        """
+        return stack_rnn(self.W_emb[x1], mask1, self.doc_rnn,
+                         only_return_final=(self.att_func == 'last'))
+
+    def encode_questions(self, x2, mask2):
+        """
+            Final question states: batch x h, or None if the attention ignores them.
+        """
+        if not self.uses_question:
+            return None
+        return stack_rnn(self.W_emb[x2], mask2, self.question_rnn, only_return_final=True)
+
+    def attend(self, d, q, mask1):
+        if self.att_func == 'mlp':
+            return mlp_attention(d, q, mask1, *self.att_params)
+        elif self.att_func == 'bilinear':
+            return bilinear_attention(d, q, mask1, *self.att_params)
+        elif self.att_func == 'avg':
+            return average_pooling(d, mask1)
+        elif self.att_func == 'last':
+            return d
+        return dot_attention(d, q, mask1)
+
+    def output(self, att):
+        return softmax(np.dot(att, self.W_out) + self.b_out)
+
+    def candidate_logits(self, att, l):
+        """
+            Output logits of the candidates only: l holds candidate entity
+            ids padded with -1 (utils.Candidates.padded), padding is -inf.
+        """
+        ids = np.maximum(l, 0)
+        logits = np.matmul(self.W_out.T[ids], att[:, :, None])[:, :, 0] + self.b_out[ids]
+        return np.where(l >= 0, logits, -np.inf)
+
+    def answer(self, att, l):
+        """
+            Best candidate of each row, the argmax of the softmax masked by
+            the candidates. 0 (<unk_entity>) for rows without candidates.
+        """
+        best = np.argmax(self.candidate_logits(att, l), axis=-1)
+        return np.maximum(l[np.arange(len(l)), best], 0)
+
+    def candidate_proba(self, x1, mask1, x2, mask2, l):
+        """
+            Softmax over the candidates of each row, the probabilities the
+            answer is picked from. Rows without candidates are nan.
+        """
+        d = self.encode_documents(x1, mask1)
+        q = self.encode_questions(x2, mask2)
+        with np.errstate(invalid='ignore'):
+            return softmax(self.candidate_logits(self.attend(d, q, mask1), l))
+
+    def predict_proba(self, x1, mask1, x2, mask2):
+        d = self.encode_documents(x1, mask1)
+        q = self.encode_questions(x2, mask2)
+        return self.output(self.attend(d, q, mask1))
+
+    def predict(self, x1, mask1, x2, mask2, l):
+        d = self.encode_documents(x1, mask1)
+        q = self.encode_questions(x2, mask2)
+        return self.answer(self.attend(d, q, mask1), l)
+
+    def predict_shared(self, x1, mask1, x2, mask2, l, doc_index=None):
+        """
+            Answer the questions in x2 from the documents in x1 without
+            repeating a document per question: doc_index gives the row of x1,
+            mask1 and l for every question (all 0 if there is one document).
+            Each document goes through the rnn once.
+        """
+        if doc_index is None:
+            doc_index = np.zeros(len(x2), dtype='int32')
+        d = self.encode_documents(x1, mask1)
+        q = self.encode_questions(x2, mask2)
+        att = np.empty((len(x2), d.shape[-1]), dtype=d.dtype)
+        for doc in np.unique(doc_index):
+            rows = np.flatnonzero(doc_index == doc)
+            att[rows] = self.attend(np.broadcast_to(d[doc], (len(rows),) + d.shape[1:]),
+                                    None if q is None else q[rows],
+                                    np.broadcast_to(mask1[doc], (len(rows),) + mask1.shape[1:]))
+        return self.answer(att, l[doc_index])
+
+    def __call__(self, x1, mask1, x2, mask2, l, y):
+        return np.sum(self.predict(x1, mask1, x2, mask2, l) == np.asarray(y))
+
+
+def check_parity(proba_fn, model, all_examples, rtol=1e-4, atol=1e-5):
+    """
+        Compare the candidate probabilities of `model` against a compiled
+        `proba_fn` (qa_module.build_fn with_proba) on batches from
+        qa_module.gen_examples. Rows without candidates are skipped.
+        Returns the number of batches that disagree and the largest
+        absolute difference.
+    """
+    mismatches = 0
+    max_diff = 0.0
+    for x1, mask1, x2, mask2, l, y in all_examples:
+        rows = (l >= 0).any(axis=1)
+        expected = np.asarray(proba_fn(x1, mask1, x2, mask2, l))[rows]
+        got = model.candidate_proba(x1, mask1, x2, mask2, l)[rows]
+        diff = float(np.abs(expected - got).max()) if rows.any() else 0.0
+        max_diff = max(max_diff, diff)
+        if not np.allclose(expected, got, rtol=rtol, atol=atol):
+            mismatches += 1
+            logging.warning('Parity mismatch: max |theano - numpy| = %g (batch of %d)' % (diff, len(x1)))
+    return mismatches, max_diff
+
+
+if __name__ == '__main__':
+    import argparse
+    from apes.qa_system import qa_module
+
+    parser = argparse.ArgumentParser(description='Check the NumPy forward pass against the compiled Theano graph')
+    parser.add_argument('--model_file', type=str, default='model.pkl.gz')
+    parser.add_argument('--bundle_path', type=str, default=None,
+                        help='inference bundle to load instead of --model_file')
+    parser.add_argument('--test_file', type=str, required=True,
+                        help='examples in the format of utils.load_data')
+    parser.add_argument('--max_examples', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--rtol', type=float, default=1e-4)
+    parser.add_argument('--atol', type=float, default=1e-5)
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s %(message)s', datefmt='%m-%d %H:%M')
+
+    model_args, word_dict, entity_dict, _, model, _ = qa_module.load_model(
+        None, model_file=args.model_file, backend='numpy', bundle_dir=args.bundle_path)
+    _, test_fn, _ = qa_module.build_fn(model_args, np.array(model.params[0]), inference_only=True,
+                                       param_values=model.params, with_proba=True)
+    examples = utils.load_data(args.test_file, args.max_examples, relabeling=model_args.relabeling)
+    x1, x2, l, y = utils.vectorize(examples, word_dict, entity_dict, model_args)
+    all_examples = qa_module.gen_examples(x1, x2, l, y, args.batch_size)
+    mismatches, max_diff = check_parity(test_fn.proba, model, all_examples, rtol=args.rtol, atol=args.atol)
+    logging.info('%d of %d batches disagree, max |theano - numpy| = %g'
+                 % (mismatches, len(all_examples), max_diff))
+    if mismatches:
+        raise SystemExit(1)
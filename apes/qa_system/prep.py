@@ -1,14 +1,183 @@
+"""
+    Convert the CNN / Daily Mail .question files to the text format read by
+    utils.iter_examples: question, answer, document and a blank line.
+
+    Straight from the archives, without extracting them:
+        python -m apes.qa_system.prep --archive=cnn.tgz --archive=dailymail.tgz --output_dir=data --merge
+    The archives are read sequentially and every --shard_size files are
+    parsed by one of --workers processes, which writes
+    data/<split>/<archive>-<n>.txt. data/index.json lists the shards of each
+    split with their range of examples; --merge also concatenates them into
+    data/<split>.txt.
+
+    From an extracted folder, in one process:
+        python -m apes.qa_system.prep --folder_path=cnn --output=cnn.txt
+"""
 import os
-from utils import create_data
+import json
+import shutil
+import logging
+import tarfile
 import argparse
+import multiprocessing
+from collections import deque
+from apes.qa_system import utils
+
+INDEX_FILE = 'index.json'
+
+SPLITS = ('training', 'validation', 'test')
+
+
+def parse_question(text):
+    """
+        (question, answer, document) of a .question file: url, document,
+        question and answer lines separated by blank lines, then the entity
+        mapping. None if the file is truncated.
+    """
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    if len(lines) < 7:
+        return None
+    return lines[4], lines[6], lines[2]
+
+
+def format_example(question, answer, document):
+    return '%s\n%s\n%s\n\n' % (question, answer, document)
+
+
+def iter_archive(archive_path, splits=SPLITS):
+    """
+        (split, story id, contents) of the .question files in a CNN / Daily
+        Mail archive (<corpus>/questions/<split>/<story id>.question), read
+        from the compressed stream in archive order.
+    """
+    with tarfile.open(archive_path, 'r|*') as tar:
+        for member in tar:
+            parts = member.name.split('/')
+            if not member.isfile() or not parts[-1].endswith('.question'):
+                continue
+            if len(parts) < 2 or parts[-2] not in splits:
+                continue
+            yield parts[-2], parts[-1][:-len('.question')], tar.extractfile(member).read()
+
+
+def archive_name(archive_path):
+    name = os.path.basename(archive_path)
+    for ext in ('.tgz', '.gz', '.tar'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+
+def write_shard(shard_path, contents):
+    """
+        Parse the .question `contents` (bytes) into `shard_path`.
+    """
+    examples = skipped = 0
+    with open(shard_path, 'w', encoding='utf-8') as f:
+        for data in contents:
+            example = parse_question(data.decode('utf-8'))
+            if example is None:
+                skipped += 1
+                continue
+            f.write(format_example(*example))
+            examples += 1
+    return {'examples': examples, 'skipped': skipped, 'bytes': os.path.getsize(shard_path)}
+
+
+def preprocess_archives(archives, output_dir, splits=SPLITS, shard_size=10000, workers=None, merge=False):
+    """
+        Write the examples of `archives` as shards in `output_dir` (see the
+        module docstring) and return the index.
+    """
+    workers = workers or os.cpu_count() or 1
+    for split in splits:
+        os.makedirs(os.path.join(output_dir, split), exist_ok=True)
+
+    shards = {split: [] for split in splits}
+    pending = deque()
+
+    def wait(max_pending):
+        while len(pending) > max_pending:
+            shard, result = pending.popleft()
+            shard.update(result.get())
+            logging.info('%s: %d examples' % (shard['path'], shard['examples']))
+
+    with multiprocessing.Pool(workers) as pool:
+        def submit(split, name, contents):
+            path = os.path.join(split, '%s-%05d.txt' % (name, len(shards[split])))
+            shard = {'path': path, 'archive': name}
+            shards[split].append(shard)
+            pending.append((shard, pool.apply_async(write_shard, (os.path.join(output_dir, path), contents))))
+            # bounds the file contents held in memory
+            wait(2 * workers)
+
+        for archive in archives:
+            name = archive_name(archive)
+            contents = {split: [] for split in splits}
+            for split, _, data in iter_archive(archive, splits):
+                contents[split].append(data)
+                if len(contents[split]) >= shard_size:
+                    submit(split, name, contents[split])
+                    contents[split] = []
+            for split in splits:
+                if contents[split]:
+                    submit(split, name, contents[split])
+        wait(0)
+
+    index = {}
+    for split in splits:
+        start = 0
+        for shard in shards[split]:
+            shard['start'] = start
+            start += shard['examples']
+        index[split] = {'examples': start, 'shards': shards[split]}
+        if merge:
+            index[split]['merged'] = merge_shards(output_dir, split, shards[split])
+    with open(os.path.join(output_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+def merge_shards(output_dir, split, shards):
+    path = split + '.txt'
+    with open(os.path.join(output_dir, path), 'wb') as out:
+        for shard in shards:
+            with open(os.path.join(output_dir, shard['path']), 'rb') as f:
+                shutil.copyfileobj(f, out, 1 << 20)
+    return path
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Preprocess corpus dataset')
-    parser.add_argument('--folder_path', type=str, required=True,
-                        help='required path to questions')
-    parser.add_argument('--output', type=str, required=True,
-                        help='data output filename')
+    parser.add_argument('--archive', type=str, action='append', default=[],
+                        help='CNN / Daily Mail questions archive, can be repeated')
+    parser.add_argument('--output_dir', type=str, default=None,
+                        help='where to write the shards of the archives')
+    parser.add_argument('--splits', type=str, nargs='+', default=list(SPLITS))
+    parser.add_argument('--shard_size', type=int, default=10000,
+                        help='.question files per shard')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='parsing processes, default: one per cpu')
+    parser.add_argument('--merge', action='store_true',
+                        help='also write one <split>.txt per split')
+    parser.add_argument('--folder_path', type=str, default=None,
+                        help='path to an extracted corpus with a questions folder')
+    parser.add_argument('--output', type=str, default=None,
+                        help='data output filename (with --folder_path)')
     args = parser.parse_args()
 
-    for data_type in ['training', 'test']:
-        create_data(os.path.join(args.folder_path, 'questions/'+data_type), data_type+'_'+args.output)
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%m-%d %H:%M')
+    if args.archive:
+        if args.output_dir is None:
+            parser.error('--output_dir is required with --archive')
+        index = preprocess_archives(args.archive, args.output_dir, splits=args.splits,
+                                    shard_size=args.shard_size, workers=args.workers, merge=args.merge)
+        for split in args.splits:
+            logging.info('%s: %d examples in %d shards'
+                         % (split, index[split]['examples'], len(index[split]['shards'])))
+    elif args.folder_path is not None and args.output is not None:
+        for data_type in ['training', 'test']:
+            utils.create_data(os.path.join(args.folder_path, 'questions/' + data_type),
+                              data_type + '_' + args.output)
+    else:
+        parser.error('either --archive or --folder_path and --output are required')
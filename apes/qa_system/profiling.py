@@ -0,0 +1,212 @@
+"""
+    Stage-level timing for apes.evaluate and qa_module.main. Code marks its
+    stages with
+
+        with profiling.stage('vectorize', examples=n) as s:
+            ...
+            s.add(tokens=num_tokens)
+
+    which costs a function call when profiling is off. Within a session
+    (the --profile flags) each stage accumulates wall time, calls, examples
+    and tokens, and the memory of the process: its RSS when a call ends and
+    how much a call raised its peak RSS. The session writes them as a JSON
+    report:
+
+        {"argv": [...], "seconds": 12.3, "peak_rss_mb": 512.0,
+         "stages": {"vectorize": {"seconds": 1.2, "calls": 10, "examples": 10000,
+                                  "tokens": 7600000, "examples_per_s": ...,
+                                  "tokens_per_s": ..., "rss_mb": 480.0,
+                                  "peak_rss_mb": 512.0, "peak_growth_mb": 120.0},
+                    ...}}
+
+    Stages may nest (load_model contains compile) and stages timed in other
+    threads overlap the main thread, so their seconds do not add up to the
+    total. rss_mb is the largest RSS at the end of a call of the stage, from
+    /proc/self/statm (0 where it does not exist). The peaks come from
+    ru_maxrss, the high-water mark of the process, read when a call starts
+    and ends: peak_growth_mb adds up how much the calls of the stage raised
+    it, and peak_rss_mb is the highest mark a call of the stage reached (0
+    if none raised it). Memory allocated and freed within a call counts, but
+    a call that stays under an earlier peak shows no growth, and a stage
+    overlapping another one in a thread shares the growth with it. The
+    report's peak_rss_mb is the peak of the whole process.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    """
+        Peak resident set size of this process so far, 0 if unknown.
+    """
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024.0
+
+
+try:
+    _page_size = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _page_size = 4096
+
+
+def rss_mb():
+    """
+        Current resident set size of this process, 0 if unknown.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return pages * _page_size / float(1 << 20)
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, examples=0, tokens=0):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage(object):
+
+    def __init__(self, profiler, name, examples=0, tokens=0):
+        self.profiler = profiler
+        self.name = name
+        self.examples = examples
+        self.tokens = tokens
+
+    def add(self, examples=0, tokens=0):
+        self.examples += examples
+        self.tokens += tokens
+
+    def __enter__(self):
+        self.peak = peak_rss_mb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start, self.examples, self.tokens, self.peak)
+        return False
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.stages = {}
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, examples=0, tokens=0, peak_before=None):
+        rss = rss_mb()
+        peak = peak_rss_mb()
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = {'seconds': 0.0, 'calls': 0, 'examples': 0, 'tokens': 0,
+                                             'rss_mb': 0.0, 'peak_rss_mb': 0.0, 'peak_growth_mb': 0.0}
+            stats['seconds'] += seconds
+            stats['calls'] += 1
+            stats['examples'] += int(examples)
+            stats['tokens'] += int(tokens)
+            stats['rss_mb'] = max(stats['rss_mb'], rss)
+            if peak_before is not None and peak > peak_before:
+                stats['peak_rss_mb'] = max(stats['peak_rss_mb'], peak)
+                stats['peak_growth_mb'] += peak - peak_before
+
+    def merge(self, stages):
+        """
+            Add the stages of another profiler, e.g. of a worker process.
+        """
+        with self.lock:
+            for name, other in stages.items():
+                stats = self.stages.setdefault(name, dict(other, seconds=0.0, calls=0, examples=0, tokens=0,
+                                                                  peak_growth_mb=0.0))
+                for key in ('seconds', 'calls', 'examples', 'tokens', 'peak_growth_mb'):
+                    stats[key] += other[key]
+                for key in ('rss_mb', 'peak_rss_mb'):
+                    stats[key] = max(stats[key], other[key])
+
+    def report(self):
+        stages = {}
+        with self.lock:
+            for name, stats in self.stages.items():
+                stats = dict(stats)
+                seconds = max(stats['seconds'], 1e-9)
+                stats['examples_per_s'] = stats['examples'] / seconds
+                stats['tokens_per_s'] = stats['tokens'] / seconds
+                stages[name] = stats
+        return {'argv': sys.argv, 'seconds': time.perf_counter() - self.start,
+                'peak_rss_mb': peak_rss_mb(), 'stages': stages}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+_profiler = None
+
+
+def active():
+    """
+        The Profiler of the current session, or None.
+    """
+    return _profiler
+
+
+def stage(name, examples=0, tokens=0):
+    if _profiler is None:
+        return _NULL_STAGE
+    return Stage(_profiler, name, examples, tokens)
+
+
+def restart():
+    """
+        Start over with an empty Profiler if a session is active, for forked
+        workers whose stages are merged back by the parent. Returns it.
+    """
+    global _profiler
+    if _profiler is not None:
+        _profiler = Profiler()
+    return _profiler
+
+
+def merge(stages):
+    if _profiler is not None and stages:
+        _profiler.merge(stages)
+
+
+@contextmanager
+def session(path):
+    """
+        Profile the block and write the report to `path`, a no-op if None.
+    """
+    global _profiler
+    if path is None:
+        yield None
+        return
+    _profiler = profiler = Profiler()
+    try:
+        yield profiler
+    finally:
+        _profiler = None
+        profiler.write(path)
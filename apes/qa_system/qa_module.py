@@ -1,45 +1,352 @@
 import numpy as np
-import lasagne
-import theano
-import theano.tensor as T
 import pickle
 from os import environ
 import sys, os
 import time
+import queue
+import hashlib
+import itertools
+import threading
+import traceback
+import multiprocessing
+from collections import deque
 from apes.qa_system import utils
 import apes.qa_system.config
 import logging
-from apes.qa_system import nn_layers
+from apes.qa_system import np_model, bundle, corpus, profiling
+try:
+    import lasagne
+    import theano
+    import theano.tensor as T
+    from apes.qa_system import nn_layers
+except ImportError:
+    # only needed to build / train the graph, see np_model for inference
+    lasagne = theano = T = nn_layers = None
 
 base_file_path = os.path.dirname(os.path.abspath(__file__))
+fn_cache_dir = environ.get('APES_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'apes'))
 
 
-def gen_examples(x1, x2, l, y, batch_size):
+def get_batches(lengths, batch_size, max_tokens=None, shuffle=False):
+    """
+        Minibatches of examples with `lengths` padded document + question
+        tokens: `batch_size` consecutive examples, or with `max_tokens`
+        examples bucketed by length filling each batch up to `max_tokens`
+        (see utils.get_token_minibatches). With `shuffle` examples are
+        shuffled within buckets of similar length and so is the batch order,
+        differently on every call.
+    """
+    if max_tokens is None:
+        if shuffle:
+            minibatches = utils.get_bucket_minibatches(lengths, batch_size)
+        else:
+            minibatches = utils.get_minibatches(len(lengths), batch_size)
+    else:
+        # coarser buckets when shuffling so batches differ between epochs
+        minibatches = utils.get_token_minibatches(lengths, max_tokens, shuffle=shuffle,
+                                                  bucket_width=10 if shuffle else 1)
+    logging.info('%d batches, padding efficiency: %.2f %%'
+                 % (len(minibatches), utils.padding_efficiency(lengths, minibatches) * 100))
+    return minibatches
+
+
+def iter_batches(x1, x2, l, y, minibatches, buffers=None):
+    """
+        Padded (mb_x1, mb_mask1, mb_x2, mb_mask2, mb_l, mb_y) of each
+        minibatch, built as they are consumed. x1, x2: utils.Sequences,
+        l: utils.Candidates. With `buffers` (utils.BatchBuffers) the arrays
+        are written in reused storage instead of allocated per batch.
+    """
+    for minibatch in minibatches:
+        with profiling.stage('prepare_data', examples=len(minibatch)) as stage:
+            if buffers is not None:
+                buffers.next_batch()
+            mb_x1, mb_mask1 = x1.padded(minibatch, buffers, 'x1')
+            mb_x2, mb_mask2 = x2.padded(minibatch, buffers, 'x2')
+            batch = mb_x1, mb_mask1, mb_x2, mb_mask2, l.padded(minibatch, buffers), [y[t] for t in minibatch]
+            stage.add(tokens=mb_x1.size + mb_x2.size)
+        yield batch
+
+
+def prefetch(batches, size=2, processes=False):
+    """
+        Iterate over `batches` built by a background thread, up to `size`
+        batches ahead, so that building them overlaps train_fn. Errors of
+        the thread are raised here. Batches written in utils.BatchBuffers
+        need size + 2 slots.
+        processes: build them in a forked process instead, for a train_fn
+        that holds the GIL (see prefetch_process).
+    """
+    if processes:
+        return prefetch_process(batches, size)
+    return _prefetch_thread(batches, size)
+
+
+def _prefetch_thread(batches, size):
+    ready = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for batch in batches:
+                if not put((batch, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+        else:
+            put((end, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch, error = ready.get()
+            if batch is end:
+                if error is not None:
+                    raise error
+                return
+            yield batch
+    finally:
+        stop.set()
+        thread.join()
+
+
+def prefetch_process(batches, size=2):
+    """
+        Iterate over `batches` built by a forked process, up to `size`
+        batches ahead. The process draws its own numpy seed from the
+        parent's generator, so shuffles still differ between epochs, and its
+        profiling stages are merged back when it is done. Batches are copied
+        out as they are built, so BatchBuffers need no extra slots.
+    """
+    context = multiprocessing.get_context('fork')
+    ready = context.Queue(maxsize=size)
+    seed = np.random.randint(2 ** 31)
+
+    def produce():
+        np.random.seed(seed)
+        profiler = profiling.restart()
+        try:
+            for batch in batches:
+                # pickled now, before the buffers are reused
+                ready.put(('batch', pickle.dumps(batch, protocol=-1)))
+        except Exception:
+            ready.put(('error', traceback.format_exc()))
+        else:
+            ready.put(('end', profiler.stages if profiler is not None else None))
+
+    process = context.Process(target=produce, daemon=True)
+    process.start()
+    try:
+        while True:
+            try:
+                kind, value = ready.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError('Batch process exited with code %s' % process.exitcode)
+                continue
+            if kind == 'batch':
+                yield pickle.loads(value)
+            elif kind == 'error':
+                raise RuntimeError('Building batches failed:\n%s' % value)
+            else:
+                profiling.merge(value)
+                return
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+def gen_examples(x1, x2, l, y, batch_size, max_tokens=None, shuffle=False):
     """
         Divide examples into batches of size `batch_size`.
+        x1, x2: utils.Sequences (or lists of sequences).
+        l: utils.Candidates, batched as padded candidate ids (Candidates.padded).
+        max_tokens: instead, bucket examples by length and fill each batch up
+        to `max_tokens` padded document + question tokens (see
+        utils.get_token_minibatches), shuffled within buckets if `shuffle`.
+    """
+    if not isinstance(x1, utils.Sequences):
+        x1 = utils.Sequences.from_lists(x1)
+    if not isinstance(x2, utils.Sequences):
+        x2 = utils.Sequences.from_lists(x2)
+    minibatches = get_batches(x1.lengths() + x2.lengths(), batch_size, max_tokens=max_tokens, shuffle=shuffle)
+    return list(iter_batches(x1, x2, l, y, minibatches))
+
+
+def gen_stream_examples(examples, word_dict, entity_dict, args, batch_size, buffer_size=10000,
+                        max_tokens=None, shuffle=False, buffers=None):
+    """
+        Batches from an iterable of (document, question, answer) such as
+        utils.iter_examples, vectorized `buffer_size` examples at a time so
+        the first batches are ready before the whole file is parsed.
+        shuffle: shuffle the batches within each buffer.
+        buffers: utils.BatchBuffers to build the batches in.
+    """
+    examples = iter(examples)
+    vocab = utils.Vocabulary(word_dict, entity_dict)
+    while True:
+        chunk = list(itertools.islice(examples, buffer_size))
+        if not chunk:
+            break
+        x1, x2, l, y = utils.vectorize(tuple(zip(*chunk)), word_dict, entity_dict, args, verbose=False,
+                                       vocab=vocab)
+        minibatches = get_batches(x1.lengths() + x2.lengths(), batch_size, max_tokens=max_tokens,
+                                  shuffle=shuffle)
+        if shuffle:
+            np.random.shuffle(minibatches)
+        for ex in iter_batches(x1, x2, l, y, minibatches, buffers):
+            yield ex
+
+
+def gen_corpus_examples(data, num_labels, batch_size, max_tokens=None, shuffle=False, indices=None,
+                        buffers=None):
+    """
+        Batches of a corpus.Corpus in the layout of gen_examples, built as
+        they are consumed. Examples are sorted by document length as in
+        utils.vectorize, `shuffle` shuffles the order of the batches.
+        indices: only batch these examples.
+        buffers: utils.BatchBuffers to build the batches in.
+    """
+    if indices is None:
+        indices = np.arange(len(data))
+    indices = np.asarray(indices)
+    order = indices[np.argsort(data.doc_lengths()[indices], kind='stable')]
+    minibatches = get_batches((data.doc_lengths() + data.question_lengths())[order], batch_size,
+                              max_tokens=max_tokens, shuffle=shuffle)
+    if shuffle:
+        np.random.shuffle(minibatches)
+    for ex in iter_batches(data.documents(), data.questions(), data.labels(num_labels), data.answers,
+                           [order[minibatch] for minibatch in minibatches], buffers):
+        yield ex
+
+
+def gen_article_examples(x1, x2, l, y, doc_index, batch_size, max_tokens=None):
     """
-    minibatches = utils.get_minibatches(len(x1), batch_size)
+        Divide articles from utils.vectorize_articles into batches of about
+        `batch_size` questions. Articles are sorted by document length and
+        never split, so each document appears once per batch.
+        max_tokens: instead, fill each batch up to `max_tokens` padded
+        document + question tokens; an article over the budget gets a
+        batch of its own.
+        Returns (mb_x1, mb_mask1, mb_x2, mb_mask2, mb_l, mb_y, mb_doc_index, mb_questions)
+        where mb_doc_index points into the batch documents and mb_questions
+        are the positions of the batch questions in x2 / y.
+    """
+    questions_of = [[] for _ in range(len(x1))]
+    for question, doc in enumerate(doc_index):
+        questions_of[doc].append(question)
+
+    doc_lengths = x1.lengths()
+    question_lengths = x2.lengths()
+    batches = []
+    current = []
+    n_questions = 0
+    max_question = 0
+    for doc in np.argsort(doc_lengths, kind='stable'):
+        if not questions_of[doc]:
+            continue
+        if max_tokens is not None:
+            # documents come in increasing length, so `doc` is the longest
+            doc_questions = max(question_lengths[q] for q in questions_of[doc])
+            padded = ((len(current) + 1) * doc_lengths[doc] +
+                      (n_questions + len(questions_of[doc])) * max(max_question, doc_questions))
+            if current and padded > max_tokens:
+                batches.append(current)
+                current = []
+                n_questions = 0
+                max_question = 0
+            max_question = max(max_question, doc_questions)
+        current.append(doc)
+        n_questions += len(questions_of[doc])
+        if max_tokens is None and n_questions >= batch_size:
+            batches.append(current)
+            current = []
+            n_questions = 0
+    if current:
+        batches.append(current)
+
     all_ex = []
-    for minibatch in minibatches:
-        mb_x1 = [x1[t] for t in minibatch]
-        mb_x2 = [x2[t] for t in minibatch]
-        mb_l = l[minibatch]
-        mb_y = [y[t] for t in minibatch]
-        mb_x1, mb_mask1 = utils.prepare_data(mb_x1)
-        mb_x2, mb_mask2 = utils.prepare_data(mb_x2)
-        all_ex.append((mb_x1, mb_mask1, mb_x2, mb_mask2, mb_l, mb_y))
+    for docs in batches:
+        with profiling.stage('prepare_data') as stage:
+            mb_questions = np.array([q for doc in docs for q in questions_of[doc]])
+            mb_doc_index = np.array([i for i, doc in enumerate(docs) for _ in questions_of[doc]], dtype='int32')
+            mb_x1, mb_mask1 = x1.padded(docs)
+            mb_x2, mb_mask2 = x2.padded(mb_questions)
+            mb_y = np.array([y[q] for q in mb_questions], dtype='int32')
+            all_ex.append((mb_x1, mb_mask1, mb_x2, mb_mask2, l.padded(docs), mb_y, mb_doc_index, mb_questions))
+            stage.add(examples=len(mb_questions), tokens=mb_x1.size + mb_x2.size)
     return all_ex
 
 
-def build_fn(args, embeddings):
+def predict_articles(test_fn, x1, mask1, x2, mask2, l, doc_index):
+    """
+        Answers for a batch from gen_article_examples. Both the numpy model
+        and an inference-only PredictFn encode each document once.
+    """
+    return test_fn.predict_shared(x1, mask1, x2, mask2, l, doc_index)
+
+
+class PredictFn(object):
+    """
+        test_fn of an inference-only build. It is called like the compiled
+        test_fn and also exposes the per-example answers through `predict`,
+        the answers of questions sharing documents through `predict_shared`,
+        and the candidate probabilities through `proba` if they were compiled.
+        The compiled functions take a doc_index giving the document row of
+        every question.
+    """
+
+    def __init__(self, predict_fn, proba_fn=None):
+        self.predict_fn = predict_fn
+        self.proba_fn = proba_fn
+
+    def predict(self, x1, mask1, x2, mask2, l):
+        return self.predict_fn(x1, mask1, x2, mask2, l, np.arange(len(x2), dtype='int32'))
+
+    def predict_shared(self, x1, mask1, x2, mask2, l, doc_index=None):
+        if doc_index is None:
+            doc_index = np.zeros(len(x2), dtype='int32')
+        return self.predict_fn(x1, mask1, x2, mask2, l, doc_index)
+
+    def proba(self, x1, mask1, x2, mask2, l):
+        if self.proba_fn is None:
+            raise ValueError('Candidate probabilities were not compiled, see build_fn(with_proba=True)')
+        return self.proba_fn(x1, mask1, x2, mask2, l, np.arange(len(x2), dtype='int32'))
+
+    def __call__(self, x1, mask1, x2, mask2, l, y):
+        return np.sum(self.predict(x1, mask1, x2, mask2, l) == np.asarray(y))
+
+
+def build_fn(args, embeddings, inference_only=False, param_values=None, with_proba=False):
     """
         Build training and testing functions.
+        inference_only: skip the loss, gradients and updates, train_fn is None
+        and test_fn is a PredictFn.
+        param_values: trained parameters to load instead of args.pre_trained.
+        with_proba: with inference_only, also compile the candidate
+        probabilities as test_fn.proba (see np_model.check_parity).
     """
+    if lasagne is None:
+        raise ImportError('build_fn requires Theano and Lasagne, '
+                          'use backend="numpy" to run a trained model without them')
     in_x1 = T.imatrix('x1')
     in_x2 = T.imatrix('x2')
     in_mask1 = T.matrix('mask1')
     in_mask2 = T.matrix('mask2')
-    in_l = T.matrix('l')
+    # candidate entity ids, -1 padded
+    in_l = T.imatrix('l')
     in_y = T.ivector('y')
 
     l_in1 = lasagne.layers.InputLayer((None, None), in_x1)
@@ -88,10 +395,13 @@ def build_fn(args, embeddings):
     network = lasagne.layers.DenseLayer(att, args.num_labels,
                                         nonlinearity=lasagne.nonlinearities.softmax)
 
-    if args.pre_trained is not None:
+    if param_values is not None:
+        lasagne.layers.set_all_param_values(network, param_values, trainable=True)
+    elif args.pre_trained is not None:
         checkpoint = utils.load_params(args.pre_trained)
-        lasagne.layers.set_all_param_values(network, checkpoint[b'params'], trainable=True)
-        del checkpoint[b'params']
+        lasagne.layers.set_all_param_values(network, utils.checkpoint_values(checkpoint), trainable=True)
+        checkpoint.pop(b'params', None)
+        checkpoint.pop('params', None)
         logging.debug('Loaded pre-trained model: %s' % args.pre_trained)
         for checkpoint_param in checkpoint.items():
             logging.debug(checkpoint_param)
@@ -100,20 +410,54 @@ def build_fn(args, embeddings):
     for layer in lasagne.layers.get_all_layers(network):
         logging.debug(layer)
 
+    # The output layer is only evaluated for the candidates of each example:
+    # softmax * in_l restricted to the candidates, renormalized, is the
+    # softmax of the gathered candidate logits.
+    def candidate_logits(att_out, l):
+        cand_ids = T.maximum(l, 0)
+        logits = T.batched_dot(network.W.T[cand_ids], att_out) + network.b[cand_ids]
+        return T.switch(T.ge(l, 0), logits, -np.inf)
+
+    def candidate_answers(logits, l):
+        best = T.argmax(logits, axis=-1)
+        # 0 (<unk_entity>) when there is no candidate, as the argmax of a zero in_l row
+        return T.maximum(l[T.arange(l.shape[0]), best], 0)
+
+    params = lasagne.layers.get_all_params(network, trainable=True)
+    if inference_only:
+        # Each document goes through the rnn once, its states are repeated
+        # for its questions (doc_index) before the attention.
+        in_doc_index = T.ivector('doc_index')
+        doc_states = lasagne.layers.get_output(network1, deterministic=True)
+        shared_att = lasagne.layers.get_output(att, {network1: doc_states[in_doc_index],
+                                                     l_mask1: in_mask1[in_doc_index]},
+                                               deterministic=True)
+        shared_l = in_l[in_doc_index]
+        shared_logits = candidate_logits(shared_att, shared_l)
+        inputs = [in_x1, in_mask1, in_x2, in_mask2, in_l, in_doc_index]
+        predict_fn = theano.function(inputs, candidate_answers(shared_logits, shared_l))
+        proba_fn = None
+        if with_proba:
+            test_proba = T.exp(shared_logits - shared_logits.max(axis=1, keepdims=True))
+            test_proba = test_proba / test_proba.sum(axis=1, keepdims=True)
+            proba_fn = theano.function(inputs, test_proba)
+        return None, PredictFn(predict_fn, proba_fn), params
+
     # Test functions
-    test_prob = lasagne.layers.get_output(network, deterministic=True) * in_l
-    test_prediction = T.argmax(test_prob, axis=-1)
+    test_logits = candidate_logits(lasagne.layers.get_output(att, deterministic=True), in_l)
+    test_prediction = candidate_answers(test_logits, in_l)
     acc = T.sum(T.eq(test_prediction, in_y))
     test_fn = theano.function([in_x1, in_mask1, in_x2, in_mask2, in_l, in_y], acc)
 
     # Train functions
-    train_prediction = lasagne.layers.get_output(network) * in_l
-    train_prediction = train_prediction / \
-        train_prediction.sum(axis=1).reshape((train_prediction.shape[0], 1))
-    train_prediction = T.clip(train_prediction, 1e-7, 1.0 - 1e-7)
-    loss = lasagne.objectives.categorical_crossentropy(train_prediction, in_y).mean()
+    train_logits = candidate_logits(lasagne.layers.get_output(att, deterministic=False), in_l)
+    train_prediction = T.exp(train_logits - train_logits.max(axis=1, keepdims=True))
+    train_prediction = train_prediction / train_prediction.sum(axis=1, keepdims=True)
+    # probability of the answer, 0 if it is not a candidate
+    answer_prob = T.sum(train_prediction * T.eq(in_l, in_y.dimshuffle(0, 'x')), axis=1)
+    answer_prob = T.clip(answer_prob, 1e-7, 1.0 - 1e-7)
+    loss = -T.log(answer_prob).mean()
     # TODO: lasagne.regularization.regularize_network_params(network, lasagne.regularization.l2)
-    params = lasagne.layers.get_all_params(network, trainable=True)
 
     if args.optimizer == 'sgd':
         updates = lasagne.updates.sgd(loss, params, args.learning_rate)
@@ -129,6 +473,84 @@ def build_fn(args, embeddings):
     return train_fn, test_fn, params
 
 
+def fn_cache_key(args, *files):
+    """
+        Key of a compiled test_fn: model config, library versions and the
+        files its weights were built from.
+    """
+    key = ['PredictFn', 'candidate_head', 'shared_documents', args.vocab_size, args.embedding_size, args.hidden_size, args.bidir,
+           args.num_layers, args.rnn_type, args.att_func, args.num_labels,
+           theano.__version__, lasagne.__version__, theano.config.floatX,
+           environ.get('THEANO_FLAGS'), sys.version_info[:2]]
+    for file_name in files:
+        if file_name is not None and os.path.isfile(file_name):
+            stat = os.stat(file_name)
+            key.append((os.path.abspath(file_name), stat.st_size, stat.st_mtime))
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def load_cached_fn(key, cache_dir=None):
+    """
+        Return the cached (test_fn, params) for `key`, or None.
+    """
+    cache_file = os.path.join(cache_dir or fn_cache_dir, 'test_fn-%s.pkl' % key)
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        logging.warning('Ignoring unreadable function cache %s: %s' % (cache_file, e))
+        return None
+
+
+def save_cached_fn(key, test_fn, params, cache_dir=None):
+    """
+        Cache (test_fn, params) for `key`. A failure to pickle or write them
+        is logged and leaves the cache as it was, the next run compiles again.
+    """
+    cache_dir = cache_dir or fn_cache_dir
+    cache_file = os.path.join(cache_dir, 'test_fn-%s.pkl' % key)
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    # compiled graphs are deeply nested
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 50000))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_file, 'wb') as f:
+            pickle.dump((test_fn, params), f, protocol=-1)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        logging.warning('Could not cache the compiled test_fn in %s: %s' % (cache_file, e))
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+
+
+def tune_max_tokens(test_fn, x1, x2, l, y, candidates=(1000, 2000, 4000, 8000, 16000, 32000),
+                    max_examples=2000):
+    """
+        Time `test_fn` over up to `max_examples` examples batched with each
+        token budget in `candidates` and return the fastest budget.
+    """
+    samples = sorted(np.random.choice(len(x1), min(len(x1), max_examples), replace=False))
+    x1 = x1.take(samples)
+    x2 = x2.take(samples)
+    l = l.take(samples)
+    y = [y[k] for k in samples]
+    best_tokens, best_speed = None, 0.0
+    for max_tokens in candidates:
+        all_ex = gen_examples(x1, x2, l, y, None, max_tokens=max_tokens)
+        start_time = time.time()
+        eval_acc(test_fn, all_ex)
+        speed = len(x1) / max(time.time() - start_time, 1e-9)
+        logging.info('max_tokens = %d: %.1f examples/s' % (max_tokens, speed))
+        if speed > best_speed:
+            best_tokens, best_speed = max_tokens, speed
+    return best_tokens
+
+
 def eval_acc(test_fn, all_examples):
     """
         Evaluate accuracy on `all_examples`.
@@ -136,7 +558,8 @@ def eval_acc(test_fn, all_examples):
     acc = 0
     n_examples = 0
     for x1, mask1, x2, mask2, l, y in all_examples:
-        acc += test_fn(x1, mask1, x2, mask2, l, y)
+        with profiling.stage('test_fn', examples=len(x1), tokens=x1.size + x2.size):
+            acc += test_fn(x1, mask1, x2, mask2, l, y)
         n_examples += len(x1)
     return acc * 100.0 / n_examples
 
@@ -144,27 +567,51 @@ def main(args):
     logging.debug('-' * 50)
     logging.debug('Load data files..')
 
-    if args.debug:
-        logging.debug('*' * 10 + ' Train')
-        documents, questions, answers = utils.load_data(args.train_file, 100, relabeling=args.relabeling)
+    max_train = 100 if args.debug else None
+    max_dev = 100 if args.debug else args.max_dev
+    # a pre-tokenized corpus takes precedence over streaming the text file
+    streamed = bool(args.stream_buffer) and not args.corpus_dir
+    if args.corpus_dir:
+        logging.debug('*' * 10 + ' Corpus: %s' % args.corpus_dir)
+        train_corpus = corpus.Corpus(os.path.join(args.corpus_dir, 'train'))
+        dev_corpus = corpus.Corpus(os.path.join(args.corpus_dir, 'dev'))
+        args.num_train = len(train_corpus) if max_train is None else min(len(train_corpus), max_train)
+        args.num_dev = len(dev_corpus) if max_dev is None else min(len(dev_corpus), max_dev)
+    elif streamed:
+        # training examples are re-read every epoch, only count them here
+        logging.debug('*' * 10 + ' Train (streamed)')
+        answers = set()
+        args.num_train = 0
+
+        def train_sentences():
+            for document, question, answer in utils.iter_examples(args.train_file, max_train,
+                                                                  relabeling=args.relabeling):
+                answers.add(answer)
+                args.num_train += 1
+                yield document
+                yield question
         logging.debug('*' * 10 + ' Dev')
-        dev_examples = utils.load_data(args.dev_file, 100, relabeling=args.relabeling)
+        dev_examples = utils.load_data(args.dev_file, max_dev, relabeling=args.relabeling)
+        args.num_dev = len(dev_examples[0])
     else:
         logging.debug('*' * 10 + ' Train')
-        documents, questions, answers = utils.load_data(args.train_file, relabeling=args.relabeling)
+        documents, questions, answers = utils.load_data(args.train_file, max_train, relabeling=args.relabeling)
         logging.debug('*' * 10 + ' Dev')
-        dev_examples = utils.load_data(args.dev_file, args.max_dev, relabeling=args.relabeling)
-
-    args.num_train = len(documents)
-    args.num_dev = len(dev_examples[0])
+        dev_examples = utils.load_data(args.dev_file, max_dev, relabeling=args.relabeling)
+        args.num_train = len(documents)
+        args.num_dev = len(dev_examples[0])
 
     logging.debug('-' * 50)
-    logging.debug('Build dictionary..')
-    word_dict = utils.build_dict(documents + questions)
-    entity_markers = list(set([w for w in word_dict.keys()
-                              if w.startswith('@entity')] + answers))
-    entity_markers = ['<unk_entity>'] + entity_markers
-    entity_dict = {w: index for (index, w) in enumerate(entity_markers)}
+    if args.corpus_dir:
+        # built with the corpus, see corpus.build_corpus
+        word_dict, entity_dict = corpus.load_dicts(args.corpus_dir)
+    else:
+        logging.debug('Build dictionary..')
+        if streamed:
+            word_dict = utils.build_dict(train_sentences())
+        else:
+            word_dict = utils.build_dict(documents + questions)
+        entity_dict = utils.build_entity_dict(word_dict, answers)
 
     # save entity dictionary
     # print('Saving entity dictionary, entity count {}'.format(len(entity_dict)))
@@ -187,7 +634,8 @@ def main(args):
     embeddings = utils.gen_embeddings(word_dict, args.embedding_size, args.embedding_file)
     (args.vocab_size, args.embedding_size) = embeddings.shape
     logging.debug('Compile functions..')
-    train_fn, test_fn, params = build_fn(args, embeddings)
+    with profiling.stage('compile'):
+        train_fn, test_fn, params = build_fn(args, embeddings)
     logging.debug('Done.')
     if args.prepare_model:
         return args, word_dict, entity_dict, train_fn, test_fn, params
@@ -197,9 +645,15 @@ def main(args):
 
     logging.debug('-' * 50)
     logging.debug('Intial test..')
-    dev_x1, dev_x2, dev_l, dev_y = utils.vectorize(dev_examples, word_dict, entity_dict)
+    if args.corpus_dir:
+        dev_x1, dev_x2, dev_l, dev_y = dev_corpus.vectorize(args.num_labels, args.num_dev)
+    else:
+        dev_x1, dev_x2, dev_l, dev_y = utils.vectorize(dev_examples, word_dict, entity_dict, args)
     assert len(dev_x1) == args.num_dev
-    all_dev = gen_examples(dev_x1, dev_x2, dev_l, dev_y, args.batch_size)
+    if args.max_tokens == 0:
+        args.max_tokens = tune_max_tokens(test_fn, dev_x1, dev_x2, dev_l, dev_y)
+        logging.info('Picked max_tokens = %d' % args.max_tokens)
+    all_dev = gen_examples(dev_x1, dev_x2, dev_l, dev_y, args.batch_size, max_tokens=args.max_tokens)
     dev_acc = eval_acc(test_fn, all_dev)
     logging.debug('Dev accuracy: %.2f %%' % dev_acc)
     best_acc = dev_acc
@@ -212,29 +666,68 @@ def main(args):
     # Training
     logging.debug('-' * 50)
     logging.debug('Start training..')
-    train_x1, train_x2, train_l, train_y = utils.vectorize((documents, questions, answers), word_dict, entity_dict)
-    assert len(train_x1) == args.num_train
+    if args.corpus_dir:
+        num_batches = len(utils.get_minibatches(args.num_train, args.batch_size)) \
+            if args.max_tokens is None else 0
+    elif streamed:
+        # unknown until the first epoch is read
+        num_batches = 0
+        recent_train = deque(maxlen=max(1, args.num_dev // args.batch_size))
+    else:
+        train_x1, train_x2, train_l, train_y = utils.vectorize((documents, questions, answers), word_dict,
+                                                               entity_dict, args)
+        assert len(train_x1) == args.num_train
+        train_lengths = train_x1.lengths() + train_x2.lengths()
+    # the batch being trained on, the prefetched ones, the one being built
+    # and those kept in recent_train must not be overwritten
+    train_buffers = utils.BatchBuffers(slots=args.prefetch + 2 + (recent_train.maxlen if streamed else 0))
     start_time = time.time()
     n_updates = 0
 
-    all_train = gen_examples(train_x1, train_x2, train_l, train_y, args.batch_size)
     for epoch in range(args.num_epoches):
-        np.random.shuffle(all_train)
+        if args.corpus_dir:
+            all_train = gen_corpus_examples(train_corpus, args.num_labels, args.batch_size,
+                                            max_tokens=args.max_tokens, shuffle=True,
+                                            indices=np.arange(args.num_train), buffers=train_buffers)
+        elif streamed:
+            all_train = gen_stream_examples(utils.iter_examples(args.train_file, max_train,
+                                                                relabeling=args.relabeling),
+                                            word_dict, entity_dict, args, args.batch_size,
+                                            buffer_size=args.stream_buffer, max_tokens=args.max_tokens,
+                                            shuffle=True, buffers=train_buffers)
+        else:
+            # batches are built as they are consumed, reshuffled every epoch
+            minibatches = get_batches(train_lengths, args.batch_size, max_tokens=args.max_tokens, shuffle=True)
+            num_batches = len(minibatches)
+            all_train = iter_batches(train_x1, train_x2, train_l, train_y, minibatches, train_buffers)
+        if args.prefetch > 0:
+            all_train = prefetch(all_train, args.prefetch, processes=args.prefetch_processes)
         for idx, (mb_x1, mb_mask1, mb_x2, mb_mask2, mb_l, mb_y) in enumerate(all_train):
             logging.debug('#Examples = %d, max_len = %d' % (len(mb_x1), mb_x1.shape[1]))
-            train_loss = train_fn(mb_x1, mb_mask1, mb_x2, mb_mask2, mb_l, mb_y)
+            with profiling.stage('train_fn', examples=len(mb_x1), tokens=mb_x1.size + mb_x2.size):
+                train_loss = train_fn(mb_x1, mb_mask1, mb_x2, mb_mask2, mb_l, mb_y)
             logging.debug('Epoch = %d, iter = %d (max = %d), loss = %.2f, elapsed time = %.2f (s)' %
-                         (epoch, idx, len(all_train), train_loss, time.time() - start_time))
+                         (epoch, idx, num_batches, train_loss, time.time() - start_time))
             n_updates += 1
+            if streamed:
+                recent_train.append((mb_x1, mb_mask1, mb_x2, mb_mask2, mb_l, mb_y))
 
             if n_updates % args.eval_iter == 0:
-                samples = sorted(np.random.choice(args.num_train, min(args.num_train, args.num_dev),
-                                                  replace=False))
-                sample_train = gen_examples([train_x1[k] for k in samples],
-                                            [train_x2[k] for k in samples],
-                                            train_l[samples],
-                                            [train_y[k] for k in samples],
-                                            args.batch_size)
+                if streamed:
+                    # the streamed examples are not kept, use the latest batches
+                    sample_train = list(recent_train)
+                else:
+                    samples = sorted(np.random.choice(args.num_train, min(args.num_train, args.num_dev),
+                                                      replace=False))
+                    if args.corpus_dir:
+                        sample_train = list(gen_corpus_examples(train_corpus, args.num_labels, args.batch_size,
+                                                                max_tokens=args.max_tokens, indices=samples))
+                    else:
+                        sample_train = gen_examples(train_x1.take(samples),
+                                                    train_x2.take(samples),
+                                                    train_l.take(samples),
+                                                    [train_y[k] for k in samples],
+                                                    args.batch_size, max_tokens=args.max_tokens)
                 logging.debug('Train accuracy: %.2f %%' % eval_acc(test_fn, sample_train))
                 dev_acc = eval_acc(test_fn, all_dev)
                 logging.debug('Dev accuracy: %.2f %%' % dev_acc)
@@ -243,17 +736,18 @@ def main(args):
                     logging.debug('Best dev accuracy: epoch = %d, n_udpates = %d, acc = %.2f %%'
                                  % (epoch, n_updates, dev_acc))
                     utils.save_params(args.model_file, params, epoch=epoch, n_updates=n_updates)
-
+        if args.corpus_dir or streamed:
+            num_batches = idx + 1
 
 from collections import namedtuple
 def qa_model(debug=False, test_only=False, prepare_model=False, 
     random_seed=1013, train_file=None, dev_file=None, pre_trained=None, model_file='model.pkl.gz', 
     log_file=None, embedding_file=None, max_dev=None, relabeling=True, 
     embedding_size=None, hidden_size=128, bidir=True, num_layers=1, rnn_type='gru', 
-    att_func='bilinear', batch_size=32, num_epoches=100, eval_iter=100, dropout_rate=0.2, 
+    att_func='bilinear', batch_size=32, max_tokens=None, stream_buffer=None, corpus_dir=None, prefetch=2, prefetch_processes=False, profile=None, num_epoches=100, eval_iter=100, dropout_rate=0.2, 
     optimizer='sgd', learning_rate=0.1, grad_clipping=10.0):
 
-    args = namedtuple("args", "debug, test_only, prepare_model, random_seed, train_file, dev_file, pre_trained, model_file, log_file, embedding_file, max_dev, relabeling, embedding_size, hidden_size, bidir, num_layers, rnn_type, att_func, batch_size, num_epoches, eval_iter, dropout_rate, optimizer, learning_rate, grad_clipping")
+    args = namedtuple("args", "debug, test_only, prepare_model, random_seed, train_file, dev_file, pre_trained, model_file, log_file, embedding_file, max_dev, relabeling, embedding_size, hidden_size, bidir, num_layers, rnn_type, att_func, batch_size, max_tokens, stream_buffer, corpus_dir, prefetch, prefetch_processes, profile, num_epoches, eval_iter, dropout_rate, optimizer, learning_rate, grad_clipping")
     args.debug = debug
     args.test_only = test_only
     args.prepare_model = prepare_model
@@ -273,6 +767,12 @@ def qa_model(debug=False, test_only=False, prepare_model=False,
     args.rnn_type = rnn_type
     args.att_func = att_func
     args.batch_size = batch_size
+    args.max_tokens = max_tokens
+    args.stream_buffer = stream_buffer
+    args.corpus_dir = corpus_dir
+    args.prefetch = prefetch
+    args.prefetch_processes = prefetch_processes
+    args.profile = profile
     args.num_epoches = num_epoches
     args.eval_iter = eval_iter
     args.dropout_rate = dropout_rate
@@ -284,10 +784,10 @@ def qa_model(debug=False, test_only=False, prepare_model=False,
     np.random.seed(args.random_seed)
     lasagne.random.set_rng(np.random.RandomState(args.random_seed))
 
-    if args.train_file is None:
+    if args.train_file is None and args.corpus_dir is None:
         raise ValueError('train_file is not specified.')
 
-    if args.dev_file is None:
+    if args.dev_file is None and args.corpus_dir is None:
         raise ValueError('dev_file is not specified.')
 
     if args.rnn_type == 'lstm':
@@ -315,16 +815,17 @@ def qa_model(debug=False, test_only=False, prepare_model=False,
                             format='%(asctime)s %(message)s', datefmt='%m-%d %H:%M')
 
     logging.debug(' '.join(sys.argv))
-    return main(args)
+    with profiling.session(args.profile):
+        return main(args)
 
 def checkpoint_args(debug=False, test_only=False, prepare_model=False, 
     random_seed=1013, train_file=None, dev_file=None, pre_trained=None, model_file='model.pkl.gz', 
     log_file=None, embedding_file=None, max_dev=None, relabeling=True, 
     embedding_size=None, hidden_size=128, bidir=True, num_layers=1, rnn_type='gru', 
-    att_func='bilinear', batch_size=32, num_epoches=100, eval_iter=100, dropout_rate=0.2, 
+    att_func='bilinear', batch_size=32, max_tokens=None, stream_buffer=None, corpus_dir=None, prefetch=2, prefetch_processes=False, profile=None, num_epoches=100, eval_iter=100, dropout_rate=0.2, 
     optimizer='sgd', learning_rate=0.1, grad_clipping=10.0):
 
-    args = namedtuple("args", "debug, test_only, prepare_model, random_seed, train_file, dev_file, pre_trained, model_file, log_file, embedding_file, max_dev, relabeling, embedding_size, hidden_size, bidir, num_layers, rnn_type, att_func, batch_size, num_epoches, eval_iter, dropout_rate, optimizer, learning_rate, grad_clipping")
+    args = namedtuple("args", "debug, test_only, prepare_model, random_seed, train_file, dev_file, pre_trained, model_file, log_file, embedding_file, max_dev, relabeling, embedding_size, hidden_size, bidir, num_layers, rnn_type, att_func, batch_size, max_tokens, stream_buffer, corpus_dir, prefetch, prefetch_processes, profile, num_epoches, eval_iter, dropout_rate, optimizer, learning_rate, grad_clipping")
     args.debug = debug
     args.test_only = test_only
     args.prepare_model = prepare_model
@@ -344,6 +845,12 @@ def checkpoint_args(debug=False, test_only=False, prepare_model=False,
     args.rnn_type = rnn_type
     args.att_func = att_func
     args.batch_size = batch_size
+    args.max_tokens = max_tokens
+    args.stream_buffer = stream_buffer
+    args.corpus_dir = corpus_dir
+    args.prefetch = prefetch
+    args.prefetch_processes = prefetch_processes
+    args.profile = profile
     args.num_epoches = num_epoches
     args.eval_iter = eval_iter
     args.dropout_rate = dropout_rate
@@ -353,20 +860,23 @@ def checkpoint_args(debug=False, test_only=False, prepare_model=False,
     
     # args = config.get_args()
     np.random.seed(args.random_seed)
-    lasagne.random.set_rng(np.random.RandomState(args.random_seed))
+    if lasagne is not None:
+        lasagne.random.set_rng(np.random.RandomState(args.random_seed))
 
-    if args.train_file is None:
+    if args.train_file is None and args.corpus_dir is None:
         raise ValueError('train_file is not specified.')
 
-    if args.dev_file is None:
+    if args.dev_file is None and args.corpus_dir is None:
         raise ValueError('dev_file is not specified.')
 
-    if args.rnn_type == 'lstm':
+    if args.rnn_type not in ('lstm', 'gru'):
+        raise NotImplementedError('rnn_type = %s' % args.rnn_type)
+    if lasagne is None:
+        args.rnn_layer = None
+    elif args.rnn_type == 'lstm':
         args.rnn_layer = lasagne.layers.LSTMLayer
-    elif args.rnn_type == 'gru':
-        args.rnn_layer = lasagne.layers.GRULayer
     else:
-        raise NotImplementedError('rnn_type = %s' % args.rnn_type)
+        args.rnn_layer = lasagne.layers.GRULayer
 
     if args.embedding_file is not None:
         dim = utils.get_dim(args.embedding_file)
@@ -389,34 +899,101 @@ def checkpoint_args(debug=False, test_only=False, prepare_model=False,
     return args
 
 def test(args, word_dict, entity_dict, train_fn, test_fn, params):
-    dev_examples = utils.load_data(args.dev_file, args.max_dev, relabeling=args.relabeling)
-    dev_x1, dev_x2, dev_l, dev_y = utils.vectorize(dev_examples, word_dict, entity_dict)
+    if args.corpus_dir:
+        dev_corpus = corpus.Corpus(os.path.join(args.corpus_dir, 'dev'))
+        dev_x1, dev_x2, dev_l, dev_y = dev_corpus.vectorize(args.num_labels, args.max_dev)
+    else:
+        dev_examples = utils.load_data(args.dev_file, args.max_dev, relabeling=args.relabeling)
+        dev_x1, dev_x2, dev_l, dev_y = utils.vectorize(dev_examples, word_dict, entity_dict, args)
     assert len(dev_x1) == args.num_dev
-    all_dev = gen_examples(dev_x1, dev_x2, dev_l, dev_y, args.batch_size)
+    if args.max_tokens == 0:
+        args.max_tokens = tune_max_tokens(test_fn, dev_x1, dev_x2, dev_l, dev_y)
+    all_dev = gen_examples(dev_x1, dev_x2, dev_l, dev_y, args.batch_size, max_tokens=args.max_tokens)
     dev_acc = eval_acc(test_fn, all_dev)
     return dev_acc
 
 
-def load_model(embedding_file, model_file='model.pkl.gz',  entity_dictionry_filename='entity_dict.pkl', words_dictionry_filename='word_dict.pkl'):
-
-    args = checkpoint_args(embedding_file=embedding_file,model_file=model_file, train_file='None2', dev_file='None' )
-
-    with open(os.path.join(base_file_path, entity_dictionry_filename), 'rb') as entity_f:
-        entity_dict = pickle.load(entity_f)
-        # print('{} entities found!'.format(len(entity_dict)))
-
-    with open(os.path.join(base_file_path, words_dictionry_filename), 'rb') as entity_f:
-        word_dict = pickle.load(entity_f)
+def load_model(embedding_file, model_file='model.pkl.gz',  entity_dictionry_filename='entity_dict.pkl', words_dictionry_filename='word_dict.pkl',
+               backend='theano', inference_only=False, use_cache=True, bundle_dir=None):
+    """
+        backend='theano' compiles the Lasagne graph, backend='numpy' runs the
+        trained weights through np_model.NumpyQAModel instead and needs no Theano.
+        inference_only: only compile test_fn (train_fn is None). The compiled
+        test_fn is then cached under `fn_cache_dir` unless use_cache is False.
+        bundle_dir: load weights and dictionaries from an inference bundle
+        (see bundle.py) instead of `model_file` and the dictionary pickles.
+
+        The embedding file is only read when there are no trained weights,
+        the trained embedding matrix is part of the checkpoint.
+    """
+    if backend not in ('theano', 'numpy'):
+        raise NotImplementedError('backend = %s' % backend)
+
+    if bundle_dir is not None:
+        with profiling.stage('load_bundle'):
+            bundle_config, param_values, word_dict, entity_dict = bundle.load_bundle(bundle_dir)
+        args = checkpoint_args(embedding_size=param_values[0].shape[1], model_file=model_file,
+                               train_file='None2', dev_file='None', pre_trained=bundle_dir,
+                               **{k: bundle_config[k] for k in bundle.MODEL_CONFIG})
+        weights_file = os.path.join(bundle_dir, bundle.CONFIG_FILE)
+    else:
+        if os.path.isfile(model_file) or backend == 'numpy':
+            param_values = utils.checkpoint_values(utils.load_params(model_file))
+            args = checkpoint_args(embedding_size=param_values[0].shape[1], model_file=model_file,
+                                   train_file='None2', dev_file='None', pre_trained=model_file)
+        else:
+            logging.warning('%s not found, the model is not trained' % model_file)
+            param_values = None
+            args = checkpoint_args(embedding_file=embedding_file,model_file=model_file, train_file='None2', dev_file='None' )
+        weights_file = model_file
+
+        with profiling.stage('load_dicts'):
+            with open(os.path.join(base_file_path, entity_dictionry_filename), 'rb') as entity_f:
+                entity_dict = pickle.load(entity_f)
+                # print('{} entities found!'.format(len(entity_dict)))
+
+            with open(os.path.join(base_file_path, words_dictionry_filename), 'rb') as entity_f:
+                word_dict = pickle.load(entity_f)
 
     logging.debug('Entity markers: %d' % len(entity_dict))
-    if args.pre_trained:
-        args.num_labels = 328
+    if param_values is not None:
+        # bias of the output layer
+        args.num_labels = param_values[-1].shape[0]
     else:
         args.num_labels = len(entity_dict)
-    # Load embedding file
-    embeddings = utils.gen_embeddings(word_dict, args.embedding_size, args.embedding_file)
+    args.rnn_output_size = args.hidden_size * 2 if args.bidir else args.hidden_size
+
+    if backend == 'numpy':
+        (args.vocab_size, args.embedding_size) = param_values[0].shape
+        test_fn = np_model.NumpyQAModel(args, param_values)
+        return args, word_dict, entity_dict, None, test_fn, test_fn.params
+
+    start_time = time.time()
+    use_cache = use_cache and inference_only
+    if use_cache:
+        if param_values is not None:
+            args.vocab_size = param_values[0].shape[0]
+        else:
+            args.vocab_size = max(word_dict.values()) + 1
+        key = fn_cache_key(args, weights_file, args.embedding_file)
+        with profiling.stage('load_cached_fn'):
+            cached = load_cached_fn(key)
+        if cached is not None:
+            test_fn, params = cached
+            logging.info('Loaded cached test_fn %s in %.2f (s)' % (key, time.time() - start_time))
+            return args, word_dict, entity_dict, None, test_fn, params
+
+    if param_values is not None:
+        embeddings = np.array(param_values[0])
+    else:
+        # Load embedding file
+        embeddings = utils.gen_embeddings(word_dict, args.embedding_size, args.embedding_file)
     (args.vocab_size, args.embedding_size) = embeddings.shape
     logging.debug('Compile functions..')
-    train_fn, test_fn, params = build_fn(args, embeddings)
-    logging.debug('Done.')
-    return args, word_dict, entity_dict, train_fn, test_fn, params
\ No newline at end of file
+    with profiling.stage('compile'):
+        train_fn, test_fn, params = build_fn(args, embeddings, inference_only=inference_only,
+                                             param_values=param_values)
+    logging.info('Compiled functions in %.2f (s)' % (time.time() - start_time))
+    if use_cache:
+        save_cached_fn(key, test_fn, params)
+    return args, word_dict, entity_dict, train_fn, test_fn, params
@@ -0,0 +1,297 @@
+"""
+    Long-lived scoring server keeping the QA model loaded, in place of the
+    queries.pkl / rewards.txt polling of run_qa_model.py.
+
+    Clients connect to a Unix socket (--socket_path) or TCP port (--port) and
+    send one JSON object per line,
+        {"documents": [...], "questions": [...], "answers": [...]}
+    the same (document, question, answer) triples run_qa_model.py read from
+    queries.pkl, and get one line back:
+        {"reward": accuracy in %, "num_questions": n, "num_correct": k, "latency": seconds}
+    {"stats": true} returns request counts, latency percentiles and throughput.
+
+    Requests arriving within --batch_window seconds of each other are answered
+    by the same forward passes.
+
+        python -m apes.qa_system.server --socket_path=/tmp/apes.sock --backend=numpy
+"""
+import os
+import json
+import time
+import queue
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+from collections import deque
+import numpy as np
+from apes.qa_system import utils, qa_module
+
+
+class Request(object):
+
+    def __init__(self, documents, questions, answers):
+        if not (len(documents) == len(questions) == len(answers)):
+            raise ValueError('documents, questions and answers differ in length')
+        if not questions:
+            raise ValueError('no questions to answer')
+        self.examples = list(zip(documents, questions, answers))
+        self.received = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Metrics(object):
+    """
+        Counters since the server started, and latencies of the last
+        `window` requests.
+    """
+
+    def __init__(self, window=1000):
+        self.start = time.time()
+        self.requests = 0
+        self.questions = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add_batch(self, batch):
+        with self.lock:
+            self.batches += 1
+            for req in batch:
+                self.requests += 1
+                self.questions += len(req.examples)
+                self.latencies.append(req.result['latency'])
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+            return {'requests': self.requests,
+                    'questions': self.questions,
+                    'batches': self.batches,
+                    'requests_per_batch': self.requests / max(self.batches, 1),
+                    'latency_p50': float(np.percentile(latencies, 50)),
+                    'latency_p95': float(np.percentile(latencies, 95)),
+                    'latency_max': float(latencies.max()),
+                    'requests_per_s': self.requests / elapsed,
+                    'questions_per_s': self.questions / elapsed}
+
+
+class MicroBatcher(object):
+    """
+        Collects requests for up to `batch_window` seconds after the first one
+        (or until `max_questions` are waiting) and scores them together on a
+        single thread, so test_fn is never called concurrently.
+    """
+
+    def __init__(self, test_fn, word_dict, entity_dict, args, batch_size=32,
+                 batch_window=0.01, max_questions=1024):
+        self.test_fn = test_fn
+        self.word_dict = word_dict
+        self.entity_dict = entity_dict
+        self.vocab = utils.Vocabulary(word_dict, entity_dict)
+        self.args = args
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_questions = max_questions
+        self.metrics = Metrics()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, documents, questions, answers):
+        """
+            Blocks until the request is scored and returns its result dict.
+        """
+        req = Request(documents, questions, answers)
+        self.queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise RuntimeError(req.error)
+        return req.result
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        n_questions = len(batch[0].examples)
+        deadline = time.time() + self.batch_window
+        while n_questions < self.max_questions:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                req = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(req)
+            n_questions += len(req.examples)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.score(batch)
+            except Exception as e:
+                logging.exception('Scoring failed')
+                for req in batch:
+                    req.error = '%s: %s' % (type(e).__name__, e)
+            else:
+                self.metrics.add_batch(batch)
+            for req in batch:
+                req.done.set()
+
+    def score(self, batch):
+        # consecutive questions of a request on the same document share it
+        articles = []
+        article_request = []
+        for r, req in enumerate(batch):
+            for d, q, a in req.examples:
+                if articles and article_request[-1] == r and articles[-1][0] == d:
+                    articles[-1][1].append(q)
+                    articles[-1][2].append(a)
+                else:
+                    articles.append((d, [q], [a]))
+                    article_request.append(r)
+
+        x1, x2, l, y, doc_index = utils.vectorize_articles(articles, self.word_dict, self.entity_dict, self.args,
+                                                            vocab=self.vocab)
+        correct = np.zeros(len(x2), dtype=bool)
+        for mb_x1, mb_mask1, mb_x2, mb_mask2, mb_l, mb_y, mb_doc_index, mb_questions in \
+                qa_module.gen_article_examples(x1, x2, l, y, doc_index, self.batch_size):
+            correct[mb_questions] = qa_module.predict_articles(self.test_fn, mb_x1, mb_mask1, mb_x2, mb_mask2,
+                                                               mb_l, mb_doc_index) == mb_y
+
+        question_request = np.array(article_request)[doc_index]
+        num_correct = np.bincount(question_request, weights=correct, minlength=len(batch))
+        num_questions = np.bincount(question_request, minlength=len(batch))
+        now = time.time()
+        for r, req in enumerate(batch):
+            req.result = {'reward': num_correct[r] * 100.0 / num_questions[r],
+                          'num_questions': int(num_questions[r]),
+                          'num_correct': int(num_correct[r]),
+                          'latency': now - req.received}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                message = json.loads(line.decode('utf-8'))
+                if message.get('stats'):
+                    response = self.server.batcher.metrics.stats()
+                else:
+                    response = self.server.batcher.submit(message['documents'], message['questions'],
+                                                          message['answers'])
+            except Exception as e:
+                response = {'error': '%s: %s' % (type(e).__name__, e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class UnixScoringServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPScoringServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(batcher, socket_path=None, host='127.0.0.1', port=None):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixScoringServer(socket_path, RequestHandler)
+    elif port is not None:
+        server = TCPScoringServer((host, port), RequestHandler)
+    else:
+        raise ValueError('either socket_path or port is needed')
+    server.batcher = batcher
+    return server
+
+
+class ScoringClient(object):
+    """
+        Blocking client, one connection per client. Use one client per
+        thread to have requests batched together by the server.
+    """
+
+    def __init__(self, socket_path=None, host='127.0.0.1', port=None):
+        if socket_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(socket_path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.f = self.sock.makefile('rwb')
+
+    def _call(self, message):
+        self.f.write((json.dumps(message) + '\n').encode('utf-8'))
+        self.f.flush()
+        response = json.loads(self.f.readline().decode('utf-8'))
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def score(self, documents, questions, answers):
+        """
+            Full result dict, response['reward'] is the accuracy in %.
+        """
+        return self._call({'documents': list(documents), 'questions': list(questions),
+                           'answers': list(answers)})
+
+    def stats(self):
+        return self._call({'stats': True})
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve QA rewards over a local socket')
+    parser.add_argument('--socket_path', type=str, default=None,
+                        help='Unix socket to listen on')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None,
+                        help='TCP port to listen on, when there is no socket_path')
+    parser.add_argument('--glove_path', type=str, default=None,
+                        help='only used when there is no trained model')
+    parser.add_argument('--trained_model_path', type=str,
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                             'model.pkl.gz'))
+    parser.add_argument('--bundle_path', type=str, default=None)
+    parser.add_argument('--backend', type=str, default='theano', choices=['theano', 'numpy'])
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='questions per forward pass')
+    parser.add_argument('--batch_window', type=float, default=0.01,
+                        help='seconds to wait for more requests before scoring')
+    parser.add_argument('--max_questions', type=int, default=1024,
+                        help='questions scored together at most')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%m-%d %H:%M')
+    model_args, word_dict, entity_dict, _, test_fn, _ = qa_module.load_model(
+        embedding_file=args.glove_path, model_file=args.trained_model_path, backend=args.backend,
+        inference_only=True, bundle_dir=args.bundle_path)
+    batcher = MicroBatcher(test_fn, word_dict, entity_dict, model_args, batch_size=args.batch_size,
+                           batch_window=args.batch_window, max_questions=args.max_questions)
+    server = make_server(batcher, socket_path=args.socket_path, host=args.host, port=args.port)
+    logging.info('Serving on %s' % (args.socket_path or '%s:%d' % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if args.socket_path is not None and os.path.exists(args.socket_path):
+            os.remove(args.socket_path)
@@ -1,7 +1,6 @@
 
-import lasagne
 import numpy as np
-from apes.qa_system import config
+from apes.qa_system import config, profiling
 try:
     import cPickle as pickle
 except:
@@ -10,7 +9,12 @@ import gzip
 import logging
 from collections import Counter
 import os, glob
+import itertools
 from tqdm import tqdm
+try:
+    import lasagne
+except ImportError:
+    lasagne = None
 
 def create_data(path_to_corpus, output_name):
     '''
@@ -31,6 +35,81 @@ def create_data(path_to_corpus, output_name):
 
     output_f.close()
 
+def relabel(document, question, answer):
+    """
+        Relabel the entities of one example by their first occurence in
+        the document, then the question.
+    """
+    q_words = question.split(' ')
+    d_words = document.split(' ')
+    assert answer in d_words
+
+    entity_dict = {}
+    entity_id = 0
+    for word in d_words + q_words:
+        if (word.startswith('@entity')) and (word not in entity_dict):
+            entity_dict[word] = '@entity' + str(entity_id)
+            entity_id += 1
+
+    q_words = [entity_dict[w] if w in entity_dict else w for w in q_words]
+    d_words = [entity_dict[w] if w in entity_dict else w for w in d_words]
+    return ' '.join(d_words), ' '.join(q_words), entity_dict[answer]
+
+
+def _example_start(f, pos, chunk_size=1 << 20):
+    """
+        Offset of the first example starting at or after `pos`. Examples are
+        question, answer and document lines followed by a blank line, so an
+        example starts at 0 or right after a "\n\n".
+    """
+    if pos <= 0:
+        return 0
+    f.seek(pos - 2 if pos >= 2 else 0)
+    offset = f.tell()
+    tail = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return offset + len(tail)
+        buf = tail + chunk
+        found = buf.find(b'\n\n')
+        if found >= 0:
+            return offset + found + 2
+        offset += len(buf) - 1
+        tail = buf[-1:]
+
+
+def iter_examples(in_file, max_example=None, relabeling=True, shard=0, num_shards=1):
+    """
+        Yield (document, question, answer) from {train | dev | test}.txt one
+        at a time, see load_data.
+        shard, num_shards: only read the `shard`-th of `num_shards` byte
+        ranges of the file, each example belonging to the range it starts in.
+    """
+    num_examples = 0
+    with open(in_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        start = _example_start(f, size * shard // num_shards)
+        end = _example_start(f, size * (shard + 1) // num_shards) if shard + 1 < num_shards else size
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            question = line.decode('utf-8').strip().lower()
+            answer = f.readline().decode('utf-8').strip()
+            document = f.readline().decode('utf-8').strip().lower()
+            f.readline()
+
+            if relabeling:
+                document, question, answer = relabel(document, question, answer)
+            yield document, question, answer
+            num_examples += 1
+            if (max_example is not None) and (num_examples >= max_example):
+                break
+
+
 def load_data(in_file, max_example=None, relabeling=True):
     """
         load CNN / Daily Mail data from {train | dev | test}.txt
@@ -40,46 +119,14 @@ def load_data(in_file, max_example=None, relabeling=True):
     documents = []
     questions = []
     answers = []
-    num_examples = 0
-    f = open(in_file, 'r')
-    pbar = tqdm()
-    while True:
-        line = f.readline()
-        if not line:
-            break
-        question = line.strip().lower()
-        answer = f.readline().strip()
-        document = f.readline().strip().lower()
-
-        if relabeling:
-            q_words = question.split(' ')
-            d_words = document.split(' ')
-            assert answer in d_words
-
-            entity_dict = {}
-            entity_id = 0
-            for word in tqdm(d_words + q_words):
-                if (word.startswith('@entity')) and (word not in entity_dict):
-                    entity_dict[word] = '@entity' + str(entity_id)
-                    entity_id += 1
-
-            q_words = [entity_dict[w] if w in entity_dict else w for w in q_words]
-            d_words = [entity_dict[w] if w in entity_dict else w for w in d_words]
-            answer = entity_dict[answer]
-
-            question = ' '.join(q_words)
-            document = ' '.join(d_words)
-
-        questions.append(question)
-        answers.append(answer)
-        documents.append(document)
-        num_examples += 1
-        pbar.update()
-        f.readline()
-        if (max_example is not None) and (num_examples >= max_example):
-            break
-    f.close()
-    pbar.close()
+    with profiling.stage('load_data') as stage:
+        for document, question, answer in iter_examples(in_file, max_example, relabeling):
+            documents.append(document)
+            questions.append(question)
+            answers.append(answer)
+            if len(documents) % 10000 == 0:
+                logging.debug('Loading: processed %d examples' % len(documents))
+        stage.add(examples=len(documents))
     logging.info('#Examples: %d' % len(documents))
     return documents, questions, answers
 
@@ -90,9 +137,11 @@ def build_dict(sentences, max_words=50000):
         Only the max_words ones are kept and the remaining will be mapped to <UNK>.
     """
     word_count = Counter()
-    for sent in sentences:
-        for w in sent.split(' '):
-            word_count[w] += 1
+    with profiling.stage('build_dict') as stage:
+        for sent in sentences:
+            words = sent.split(' ')
+            word_count.update(words)
+            stage.add(tokens=len(words))
 
     ls = word_count.most_common(max_words)
     logging.info('#Words: %d -> %d' % (len(word_count), len(ls)))
@@ -107,57 +156,345 @@ def build_dict(sentences, max_words=50000):
     return {w[0]: index + 2 for (index, w) in enumerate(ls)}
 
 
+def build_entity_dict(word_dict, answers):
+    """
+        Entity markers of the vocabulary and the answers, 0 is <unk_entity>.
+    """
+    entity_markers = list(set([w for w in word_dict.keys()
+                              if w.startswith('@entity')] + list(answers)))
+    entity_markers = ['<unk_entity>'] + entity_markers
+    return {w: index for (index, w) in enumerate(entity_markers)}
+
+
+def _gather(offsets, rows):
+    # positions of the values of `rows` in a CSR array, their row and column
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    row_of = np.repeat(np.arange(len(rows)), counts)
+    columns = np.arange(len(row_of)) - (np.cumsum(counts) - counts)[row_of]
+    return starts[row_of] + columns, row_of, columns, counts
+
+
+def _empty(buffers, name, shape, dtype):
+    if buffers is None:
+        return np.empty(shape, dtype=dtype)
+    return buffers.array(name, shape, dtype)
+
+
+class BatchBuffers(object):
+    """
+        Storage reused by the padded batches of a generator. Each batch is
+        built in the next of `slots` sets of buffers (see next_batch), so it
+        stays valid until `slots` more batches are built. Buffers only grow.
+    """
+
+    def __init__(self, slots=2):
+        self.buffers = [{} for _ in range(slots)]
+        self.slot = 0
+
+    def next_batch(self):
+        self.slot = (self.slot + 1) % len(self.buffers)
+
+    def array(self, name, shape, dtype):
+        size = shape[0] * shape[1]
+        buffers = self.buffers[self.slot]
+        buf = buffers.get(name)
+        if buf is None or len(buf) < size:
+            buf = buffers[name] = np.empty(size if buf is None else max(size, 2 * len(buf)), dtype=dtype)
+        return buf[:size].reshape(shape)
+
+
+class Sequences(object):
+    """
+        Token id sequences in CSR layout: tokens[offsets[i]:offsets[i + 1]]
+        is sequence i (a document or a question). Batch inputs are built
+        by `padded`, straight from the flat tokens.
+    """
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, seqs):
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(seq) for seq in seqs])
+        if offsets[-1] == 0:
+            return cls(np.zeros(0, dtype=np.int32), offsets)
+        return cls(np.concatenate([np.asarray(seq, dtype=np.int32) for seq in seqs]), offsets)
+
+    @classmethod
+    def concatenate(cls, parts):
+        offsets = [np.zeros(1, dtype=np.int64)]
+        tokens = [np.zeros(0, dtype=np.int32)]
+        total = 0
+        for part in parts:
+            offsets.append(part.offsets[1:] + total)
+            tokens.append(part.tokens)
+            total += part.offsets[-1]
+        return cls(np.concatenate(tokens), np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def take(self, rows):
+        """
+            Sequences of `rows`, in that order.
+        """
+        positions, _, _, counts = _gather(self.offsets, rows)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return Sequences(np.asarray(self.tokens[positions]), offsets)
+
+    def padded(self, rows, buffers=None, name='x'):
+        """
+            Tokens of `rows` as a zero padded (len(rows), max length) int32
+            matrix and its floatX mask, as prepare_data. Both are written
+            with one scatter, into `buffers` (BatchBuffers) if given.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        shape = (len(rows), int(lengths.max()) if len(rows) else 0)
+        x = _empty(buffers, name, shape, np.int32)
+        x_mask = _empty(buffers, name + '_mask', shape, config._floatX)
+        filled = _empty(buffers, name + '_filled', shape, np.bool_)
+        np.less(np.arange(shape[1]), lengths[:, None], out=filled)
+        if len(rows) and rows[-1] - rows[0] == len(rows) - 1 and (np.diff(rows) == 1).all():
+            # consecutive rows, as in the length sorted batches of get_minibatches
+            x.fill(0)
+            x[filled] = self.tokens[starts[0]:starts[0] + lengths.sum()]
+        elif len(self.tokens):
+            # read row i from starts[i] on, then clear what is past its end
+            positions = _empty(buffers, name + '_positions', shape, np.int64)
+            np.add(starts[:, None], np.arange(shape[1]), out=positions)
+            np.take(self.tokens, positions, out=x, mode='clip')
+            np.multiply(x, filled, out=x)
+        else:
+            x.fill(0)
+        np.copyto(x_mask, filled)
+        return x, x_mask
+
+    @property
+    def nbytes(self):
+        return self.tokens.nbytes + self.offsets.nbytes
+
+
+class Candidates(object):
+    """
+        Candidate entities of each example in CSR layout, in place of a dense
+        (num_examples, num_labels) in_l: ids[offsets[i]:offsets[i + 1]] are
+        the entity ids occurring in document i. Batch inputs are only built
+        for a batch, by `padded` (or `mask` for a dense in_l).
+    """
+
+    def __init__(self, ids, offsets, num_labels):
+        self.ids = ids
+        self.offsets = offsets
+        self.num_labels = num_labels
+
+    @classmethod
+    def from_lists(cls, lists, num_labels):
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(ids) for ids in lists])
+        ids = np.fromiter((i for ids in lists for i in ids), dtype=np.int32, count=offsets[-1])
+        return cls(ids, offsets, num_labels)
+
+    @classmethod
+    def concatenate(cls, parts, num_labels):
+        offsets = [np.zeros(1, dtype=np.int64)]
+        ids = [np.zeros(0, dtype=np.int32)]
+        total = 0
+        for part in parts:
+            offsets.append(part.offsets[1:] + total)
+            ids.append(part.ids)
+            total += part.offsets[-1]
+        return cls(np.concatenate(ids), np.concatenate(offsets), num_labels)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def take(self, rows):
+        """
+            Candidates of `rows`, in that order.
+        """
+        positions, _, _, counts = _gather(self.offsets, rows)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return Candidates(np.asarray(self.ids[positions]), offsets, self.num_labels)
+
+    def mask(self, rows):
+        """
+            Dense (len(rows), num_labels) in_l of `rows`.
+        """
+        positions, row_of, _, counts = _gather(self.offsets, rows)
+        l = np.zeros((len(counts), self.num_labels), dtype=config._floatX)
+        l[row_of, self.ids[positions]] = 1.0
+        return l
+
+    def padded(self, rows, buffers=None, name='l'):
+        """
+            Candidate ids of `rows` as a (len(rows), max candidates) int32
+            matrix padded with -1, the `l` input of the candidate head.
+        """
+        positions, row_of, columns, counts = _gather(self.offsets, rows)
+        l = _empty(buffers, name, (len(counts), max(1, counts.max() if len(counts) else 1)), np.int32)
+        l.fill(-1)
+        l[row_of, columns] = self.ids[positions]
+        return l
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.offsets.nbytes
+
+
+class Vocabulary(object):
+    """
+        Bulk word_dict / entity_dict lookups. Each token is looked up once, in
+        a dict giving its word id (or an extra code for the entity markers
+        missing from word_dict, 0 for unknown words); token ids and document
+        entities are then read from arrays indexed by that code.
+        It is a snapshot of the dictionaries: build a new one after changing
+        them. Building it costs about as much as comparing the dictionaries,
+        so callers that vectorize repeatedly keep one and pass it as `vocab`.
+    """
+
+    def __init__(self, word_dict, entity_dict):
+        self.codes = dict(word_dict)
+        num_words = max(word_dict.values()) + 1 if word_dict else 1
+        extra = [w for w in entity_dict if w not in word_dict]
+        for k, w in enumerate(extra):
+            self.codes[w] = num_words + k
+        self.token_of = np.arange(num_words + len(extra), dtype=np.int32)
+        self.token_of[num_words:] = 0
+        self.entity_of = np.full(num_words + len(extra), -1, dtype=np.int32)
+        for w, e in entity_dict.items():
+            self.entity_of[self.codes[w]] = e
+        self.num_entities = max(entity_dict.values()) + 1 if entity_dict else 1
+
+    def encode(self, texts):
+        """
+            Codes of the space separated words of `texts`, flat, and the
+            offsets of each text.
+        """
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([text.count(' ') + 1 for text in texts])
+        # one split and one C-level lookup pass for the whole batch
+        words = ' '.join(texts).split(' ') if texts else []
+        codes = np.fromiter(map(self.codes.get, words, itertools.repeat(0)),
+                            dtype=np.int32, count=len(words))
+        return codes, offsets
+
+    def token_ids(self, codes):
+        return self.token_of[codes]
+
+    def candidates(self, codes, offsets, num_labels):
+        """
+            Candidates of each text: its distinct entity ids, sorted.
+        """
+        entities = self.entity_of[codes]
+        found = np.flatnonzero(entities >= 0)
+        text_of = np.searchsorted(offsets, found, side='right') - 1
+        pairs = np.sort(text_of * self.num_entities + entities[found])
+        pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))[:len(pairs)]]
+        return Candidates((pairs % self.num_entities).astype(np.int32),
+                          np.searchsorted(pairs // self.num_entities, np.arange(len(offsets))).astype(np.int64),
+                          num_labels)
+
+
 def vectorize(examples, word_dict, entity_dict, args,
-              sort_by_len=True, verbose=True):
+              sort_by_len=True, verbose=True, chunk_size=1000, vocab=None):
     """
         Vectorize `examples`.
-        in_x1, in_x2: sequences for document and question respecitvely.
+        in_x1, in_x2: Sequences for document and question respecitvely.
         in_y: label
-        in_l: whether the entity label occurs in the document.
-    """
-    in_x1 = []
-    in_x2 = []
-    in_l = np.zeros((len(examples[0]), args.num_labels)).astype(config._floatX)
-    in_y = []
-    # document, question, answer
-    for idx, (d, q, a) in enumerate(zip(examples[0], examples[1], examples[2])):
-        d_words = d.split(' ')
-        q_words = q.split(' ')
-        # assert (a in d_words)
-        seq1 = [word_dict[w] if w in word_dict else 0 for w in d_words]
-        seq2 = [word_dict[w] if w in word_dict else 0 for w in q_words]
-        if (len(seq1) > 0) and (len(seq2) > 0):
-            in_x1.append(seq1)
-            in_x2.append(seq2)
-            in_l[idx, [entity_dict[w] for w in d_words if w in entity_dict]] = 1.0
-            in_y.append(entity_dict[a] if a in entity_dict else 0)
-        if verbose and (idx % 10000 == 0):
-            logging.debug('Vectorization: processed %d / %d' % (idx, len(examples[0])))
-
-    def len_argsort(seq):
-        return sorted(range(len(seq)), key=lambda x: len(seq[x]))
-
-    if sort_by_len:
-        # sort by the document length
-        sorted_index = len_argsort(in_x1)
-        in_x1 = [in_x1[i] for i in sorted_index]
-        in_x2 = [in_x2[i] for i in sorted_index]
-        in_l = in_l[sorted_index]
-        in_y = [in_y[i] for i in sorted_index]
+        in_l: Candidates, the entity labels occurring in each document.
+        vocab: Vocabulary of the dictionaries, built here if None.
+    """
+    with profiling.stage('vectorize', examples=len(examples[0])) as stage:
+        if vocab is None:
+            vocab = Vocabulary(word_dict, entity_dict)
+        documents, questions, answers = examples[0], examples[1], examples[2]
+        in_x1 = []
+        in_x2 = []
+        in_l = []
+        for start in range(0, len(documents), chunk_size):
+            d_codes, d_offsets = vocab.encode(documents[start:start + chunk_size])
+            q_codes, q_offsets = vocab.encode(questions[start:start + chunk_size])
+            in_x1.append(Sequences(vocab.token_ids(d_codes), d_offsets))
+            in_x2.append(Sequences(vocab.token_ids(q_codes), q_offsets))
+            in_l.append(vocab.candidates(d_codes, d_offsets, args.num_labels))
+            if verbose and (start % 10000 == 0):
+                logging.debug('Vectorization: processed %d / %d' % (start, len(documents)))
+        in_x1 = Sequences.concatenate(in_x1)
+        in_x2 = Sequences.concatenate(in_x2)
+        in_l = Candidates.concatenate(in_l, args.num_labels)
+        in_y = [entity_dict[a] if a in entity_dict else 0 for a in answers]
+
+        if sort_by_len:
+            # sort by the document length
+            sorted_index = np.argsort(in_x1.lengths(), kind='stable')
+            in_x1 = in_x1.take(sorted_index)
+            in_x2 = in_x2.take(sorted_index)
+            in_l = in_l.take(sorted_index)
+            in_y = [in_y[i] for i in sorted_index]
+        stage.add(tokens=len(in_x1.tokens) + len(in_x2.tokens))
 
     return in_x1, in_x2, in_l, in_y
 
 
+def vectorize_articles(articles, word_dict, entity_dict, args, vocab=None, question_ids=None):
+    """
+        Vectorize `articles`, (document, questions, answers) triples, keeping
+        a single copy of every document.
+        in_x1, in_l: one entry per document, Sequences and Candidates.
+        in_x2, in_y: one entry per question, doc_index: its document.
+        vocab: Vocabulary of the dictionaries, built here if None.
+        question_ids: token ids of every question in order, as stored in a
+        QuestionsStore, used instead of tokenizing the questions.
+    """
+    if vocab is None:
+        vocab = Vocabulary(word_dict, entity_dict)
+    with profiling.stage('vectorize', examples=len(articles)) as stage:
+        d_codes, d_offsets = vocab.encode([d for d, _, _ in articles])
+        if question_ids is None:
+            q_codes, q_offsets = vocab.encode([q for _, questions, _ in articles for q in questions])
+            in_x2 = Sequences(vocab.token_ids(q_codes), q_offsets)
+        else:
+            in_x2 = Sequences.from_lists(question_ids)
+        in_y = [entity_dict[a] if a in entity_dict else 0 for _, _, answers in articles for a in answers]
+        doc_index = np.repeat(np.arange(len(articles), dtype='int32'),
+                              [len(questions) for _, questions, _ in articles])
+        stage.add(tokens=len(d_codes) + int(in_x2.offsets[-1]))
+        return (Sequences(vocab.token_ids(d_codes), d_offsets), in_x2,
+                vocab.candidates(d_codes, d_offsets, args.num_labels), in_y, doc_index)
+
+
 def prepare_data(seqs):
-    lengths = [len(seq) for seq in seqs]
-    n_samples = len(seqs)
-    max_len = np.max(lengths)
-    x = np.zeros((n_samples, max_len)).astype('int32')
-    x_mask = np.zeros((n_samples, max_len)).astype(config._floatX)
-    for idx, seq in enumerate(seqs):
-        x[idx, :lengths[idx]] = seq
-        x_mask[idx, :lengths[idx]] = 1.0
-    return x, x_mask
+    """
+        Pad a list of sequences: int32 tokens and a floatX mask, both
+        batch x longest. Lists are copied straight into the padded rows,
+        building a Sequences first is slower for a single batch.
+    """
+    lengths = np.array([len(seq) for seq in seqs])
+    mask = np.arange(lengths.max()) < lengths[:, None]
+    x = np.zeros(mask.shape, dtype='int32')
+    x[mask] = np.fromiter(itertools.chain.from_iterable(seqs), dtype='int32', count=int(lengths.sum()))
+    return x, mask.astype(config._floatX)
 
 
 def get_minibatches(n, minibatch_size, shuffle=False):
@@ -170,18 +507,78 @@ def get_minibatches(n, minibatch_size, shuffle=False):
     return minibatches
 
 
+def get_bucket_minibatches(lengths, minibatch_size, bucket_width=10):
+    """
+        Minibatches of `minibatch_size` examples of similar length, drawn
+        anew on every call: examples are ordered by length // bucket_width,
+        randomly within a bucket, and the batch order is shuffled.
+    """
+    lengths = np.asarray(lengths)
+    order = np.lexsort((np.random.random(len(lengths)), lengths // bucket_width))
+    minibatches = [order[idx:idx + minibatch_size] for idx in range(0, len(order), minibatch_size)]
+    np.random.shuffle(minibatches)
+    return minibatches
+
+
+def get_token_minibatches(lengths, max_tokens, bucket_width=1, shuffle=False):
+    """
+        Group examples of similar length into batches whose padded size,
+        number of rows x longest row, stays within `max_tokens`.
+        Examples are bucketed by length // bucket_width; with shuffle the
+        order inside each bucket is random and so is the batch order.
+    """
+    lengths = np.asarray(lengths)
+    buckets = lengths // bucket_width
+    if shuffle:
+        order = np.lexsort((np.random.random(len(lengths)), buckets))
+    else:
+        order = np.lexsort((lengths, buckets))
+    minibatches = []
+    start = 0
+    max_len = 0
+    for idx in range(len(order)):
+        length = lengths[order[idx]]
+        if idx > start and (idx - start + 1) * max(max_len, length) > max_tokens:
+            minibatches.append(order[start:idx])
+            start = idx
+            max_len = 0
+        max_len = max(max_len, length)
+    if start < len(order):
+        minibatches.append(order[start:])
+    if shuffle:
+        np.random.shuffle(minibatches)
+    return minibatches
+
+
+def padding_efficiency(lengths, minibatches):
+    """
+        Fraction of the padded batch tokens that are real tokens.
+    """
+    lengths = np.asarray(lengths)
+    padded = sum(len(mb) * lengths[mb].max() for mb in minibatches if len(mb) > 0)
+    return float(lengths.sum()) / padded if padded else 1.0
+
+
 def get_dim(in_file):
     line = open(in_file).readline()
     return len(line.split()) - 1
 
 
-def gen_embeddings(word_dict, dim, in_file=None,
-                   init=lasagne.init.Uniform()):
+def uniform_init(shape, scale=0.01):
+    """
+        Same distribution as lasagne.init.Uniform(), usable without Lasagne.
+    """
+    return np.random.uniform(-scale, scale, size=shape).astype(config._floatX)
+
+
+def gen_embeddings(word_dict, dim, in_file=None, init=None):
     """
         Generate an initial embedding matrix for `word_dict`.
         If an embedding file is not given or a word is not in the embedding file,
         a randomly initialized vector will be used.
     """
+    if init is None:
+        init = lasagne.init.Uniform() if lasagne is not None else uniform_init
 
     num_words = max(word_dict.values()) + 1
     embeddings = init((num_words, dim))
@@ -190,12 +587,14 @@ def gen_embeddings(word_dict, dim, in_file=None,
     if in_file is not None:
         logging.info('Loading embedding file: %s' % in_file)
         pre_trained = 0
-        for line in open(in_file).readlines():
-            sp = line.split()
-            assert len(sp) == dim + 1
-            if sp[0] in word_dict:
-                pre_trained += 1
-                embeddings[word_dict[sp[0]]] = [float(x) for x in sp[1:]]
+        with profiling.stage('gen_embeddings') as stage:
+            for line in open(in_file).readlines():
+                sp = line.split()
+                assert len(sp) == dim + 1
+                if sp[0] in word_dict:
+                    pre_trained += 1
+                    embeddings[word_dict[sp[0]]] = [float(x) for x in sp[1:]]
+            stage.add(examples=pre_trained)
         logging.info('Pre-trained: %d (%.2f%%)' %
                      (pre_trained, pre_trained * 100.0 / num_words))
     return embeddings
@@ -208,7 +607,7 @@ def save_params(file_name, params, **kwargs):
     """
     dic = {'params': [x.get_value() for x in params]}
     dic.update(kwargs)
-    with gzip.open(file_name, "w") as save_file:
+    with profiling.stage('checkpoint'), gzip.open(file_name, "w") as save_file:
         pickle.dump(obj=dic, file=save_file, protocol=-1)
 
 
@@ -216,6 +615,16 @@ def load_params(file_name):
     """
         Load params from file_name.
     """
-    with gzip.open(file_name, "rb") as save_file:
+    with profiling.stage('load_params'), gzip.open(file_name, "rb") as save_file:
         dic = pickle.load(save_file, encoding='bytes')
     return dic
+
+
+def checkpoint_values(checkpoint):
+    """
+        Parameter arrays of a checkpoint loaded by `load_params`, whether it
+        was written under Python 2 (bytes keys) or Python 3 (str keys).
+    """
+    if b'params' in checkpoint:
+        return checkpoint[b'params']
+    return checkpoint['params']
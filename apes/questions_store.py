@@ -0,0 +1,255 @@
+"""
+    Indexed on-disk replacement for the questions_mapping pkl.gz.
+
+    Articles are stored in SQLite keyed by story id, so a lookup reads only
+    that article instead of unpickling the whole mapping, and new articles
+    can be appended in place. Question token ids are pre-computed with the
+    word_dict given at build time (same UNK handling as utils.vectorize).
+
+    Convert an existing pickle with:
+        python -m apes.questions_store --questions_mapping_path=questions_data.pkl.gz \
+            --output=questions_data.db
+"""
+import os
+import json
+import gzip
+import pickle
+import hashlib
+import argparse
+import numpy as np
+from apes.sqlite_utils import ProcessConnection
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS articles (story_id TEXT PRIMARY KEY, mapping TEXT);
+CREATE TABLE IF NOT EXISTS questions (
+    story_id TEXT,
+    position INTEGER,
+    qid TEXT,
+    question TEXT,
+    answer TEXT,
+    question_ids BLOB,
+    PRIMARY KEY (story_id, position)
+);
+'''
+
+
+def is_store(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def word_dict_fingerprint(word_dict):
+    return hashlib.sha1(repr(sorted(word_dict.items())).encode('utf-8')).hexdigest()
+
+
+def free_marker(mapping):
+    """
+        The first @entity<n> marker not used in `mapping`.
+    """
+    n = len(mapping)
+    while '@entity%d' % n in mapping:
+        n += 1
+    return '@entity%d' % n
+
+
+def question_ids(question, word_dict):
+    return np.array([word_dict[w] if w in word_dict else 0 for w in question.split(' ')],
+                    dtype=np.int32)
+
+
+class QuestionsStore(object):
+    """
+        Read / append access to a questions store, usable wherever the
+        unpickled questions_mapping dict was:
+
+            story_id in store
+            store[story_id] -> {'mapping': {...}, 'questions': {qid: {'question', 'answer', 'question_ids'}}}
+
+        'question_ids' is only given once the store is known to match the
+        model's word_dict, see use_word_dict.
+    """
+
+    def __init__(self, path, word_dict=None):
+        self.path = path
+        self.db = ProcessConnection(path)
+        self.conn.executescript(SCHEMA)
+        self.word_dict = word_dict
+        self.ids_match = False
+        stored = self.get_meta('word_dict')
+        if word_dict is not None:
+            fingerprint = word_dict_fingerprint(word_dict)
+            if stored is None:
+                self.set_meta('word_dict', fingerprint)
+            elif stored != fingerprint:
+                raise ValueError('%s was built with a different word_dict' % path)
+            self.ids_match = True
+
+    @property
+    def conn(self):
+        return self.db.get()
+
+    def use_word_dict(self, word_dict):
+        """
+            Give the stored question_ids with each question if they were
+            computed with `word_dict`, so that scoring need not tokenize the
+            questions again. Returns whether they were.
+        """
+        self.ids_match = self.get_meta('word_dict') == word_dict_fingerprint(word_dict)
+        return self.ids_match
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def __contains__(self, story_id):
+        return self.conn.execute('SELECT 1 FROM articles WHERE story_id = ?',
+                                 (story_id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM articles').fetchone()[0]
+
+    def __iter__(self):
+        for row in self.conn.execute('SELECT story_id FROM articles'):
+            yield row[0]
+
+    def keys(self):
+        return iter(self)
+
+    def __getitem__(self, story_id):
+        row = self.conn.execute('SELECT mapping FROM articles WHERE story_id = ?',
+                                (story_id,)).fetchone()
+        if row is None:
+            raise KeyError(story_id)
+        questions = {}
+        for qid, question, answer, ids in self.conn.execute(
+                'SELECT qid, question, answer, question_ids FROM questions '
+                'WHERE story_id = ? ORDER BY position', (story_id,)):
+            questions[json.loads(qid)] = {'question': question, 'answer': answer}
+            if self.ids_match:
+                questions[json.loads(qid)]['question_ids'] = np.frombuffer(ids, dtype=np.int32)
+        return {'mapping': json.loads(row[0]), 'questions': questions}
+
+    def get(self, story_id, default=None):
+        try:
+            return self[story_id]
+        except KeyError:
+            return default
+
+    def _insert(self, story_id, article):
+        if self.word_dict is None:
+            raise ValueError('a word_dict is needed to add articles to %s' % self.path)
+        self.conn.execute('INSERT OR REPLACE INTO articles VALUES (?, ?)',
+                          (story_id, json.dumps(article['mapping'])))
+        self.conn.execute('DELETE FROM questions WHERE story_id = ?', (story_id,))
+        self.conn.executemany(
+            'INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?)',
+            [(story_id, position, json.dumps(qid), q['question'], q['answer'],
+              question_ids(q['question'], self.word_dict).tobytes())
+             for position, (qid, q) in enumerate(article['questions'].items())])
+
+    def add(self, story_id, article):
+        """
+            Add or replace one article ({'mapping': ..., 'questions': ...}).
+        """
+        with self.conn:
+            self._insert(story_id, article)
+
+    def add_many(self, articles):
+        """
+            Add (story_id, article) pairs in a single transaction.
+        """
+        with self.conn:
+            for story_id, article in articles:
+                self._insert(story_id, article)
+
+    def _extend(self, story_id, questions):
+        row = self.conn.execute('SELECT mapping FROM articles WHERE story_id = ?', (story_id,)).fetchone()
+        mapping = {} if row is None else json.loads(row[0])
+        marker_of = {}
+        for marker, name in mapping.items():
+            marker_of.setdefault(name, marker)
+        existing = set(self.conn.execute('SELECT question, answer FROM questions WHERE story_id = ?',
+                                         (story_id,)))
+        count = self.conn.execute('SELECT COUNT(*) FROM questions WHERE story_id = ?', (story_id,)).fetchone()[0]
+        added = []
+        for question, answer, question_mapping in questions:
+            renumber = {}
+            for marker, name in question_mapping.items():
+                if name not in marker_of:
+                    # keep the file's marker unless it names another entity
+                    new_marker = marker if marker not in mapping else free_marker(mapping)
+                    mapping[new_marker] = name
+                    marker_of[name] = new_marker
+                renumber[marker] = marker_of[name]
+            qa = (' '.join(renumber.get(w, w) for w in question.split(' ')), renumber.get(answer, answer))
+            if qa not in existing:
+                existing.add(qa)
+                added.append(qa)
+        self.conn.execute('INSERT OR REPLACE INTO articles VALUES (?, ?)', (story_id, json.dumps(mapping)))
+        self.conn.executemany(
+            'INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?)',
+            [(story_id, count + k, json.dumps('q%d' % (count + k + 1)), question, answer,
+              question_ids(question, self.word_dict).tobytes())
+             for k, (question, answer) in enumerate(added)])
+        return len(added)
+
+    def extend_many(self, groups):
+        """
+            Append (story_id, [(question, answer, mapping), ...]) groups in a
+            single transaction, `mapping` being the entity markers of that
+            question. Articles are created as needed. The markers of each
+            question are renumbered by entity name onto the article mapping,
+            names it does not have yet get a free marker. Questions the
+            article does not have yet get the ids q<n> following the existing
+            ones. Returns the number of questions added.
+        """
+        if self.word_dict is None:
+            raise ValueError('a word_dict is needed to add articles to %s' % self.path)
+        with self.conn:
+            return sum(self._extend(story_id, questions) for story_id, questions in groups)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def convert(questions_mapping_path, store_path, word_dict, chunk_size=10000):
+    """
+        Build a store from a questions_mapping pickle (optionally gzipped).
+    """
+    open_fn = gzip.open if questions_mapping_path.endswith('.gz') else open
+    with open_fn(questions_mapping_path, 'rb') as f:
+        questions_mapping = pickle.load(f)
+    items = list(questions_mapping.items())
+    with QuestionsStore(store_path, word_dict) as store:
+        for start in range(0, len(items), chunk_size):
+            store.add_many(items[start:start + chunk_size])
+    return len(items)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a questions_mapping pickle to an indexed store')
+    parser.add_argument('--questions_mapping_path', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--word_dict', type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'qa_system', 'word_dict.pkl'))
+    args = parser.parse_args()
+
+    with open(args.word_dict, 'rb') as f:
+        word_dict = pickle.load(f)
+    print('Converted %d articles' % convert(args.questions_mapping_path, args.output, word_dict))
@@ -0,0 +1,96 @@
+"""
+    Memoization of APES results for repeated (summary, article) pairs.
+
+    Entries are keyed on the entitized summary, the article's questions and
+    answers, and a model fingerprint, and hold the per-question correctness.
+    An in-memory LRU tier sits in front of an optional SQLite tier that is
+    shared between runs and worker processes. Writes to the SQLite tier are
+    held until `flush` (or `close`) and committed in one transaction.
+"""
+import json
+import hashlib
+from collections import OrderedDict
+from apes.sqlite_utils import ProcessConnection
+
+
+class ScoreCache(object):
+
+    def __init__(self, fingerprint, max_entries=10000, path=None):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # key -> json of the entries not written to the SQLite tier yet
+        self.pending = OrderedDict()
+        self.db = None
+        if path is not None:
+            self.db = ProcessConnection(path, timeout=60)
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, correct TEXT)')
+
+    @property
+    def conn(self):
+        return self.db.get()
+
+    def key(self, entitized_summary, questions, answers):
+        key = repr((self.fingerprint, entitized_summary, list(questions), list(answers)))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+            Per-question correctness (list of bools) or None.
+        """
+        correct = self.entries.get(key)
+        if correct is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return correct
+        if key in self.pending:
+            correct = json.loads(self.pending[key])
+            self._remember(key, correct)
+            self.hits += 1
+            return correct
+        if self.path is not None:
+            row = self.conn.execute('SELECT correct FROM scores WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                correct = json.loads(row[0])
+                self._remember(key, correct)
+                self.disk_hits += 1
+                return correct
+        self.misses += 1
+        return None
+
+    def put(self, key, correct):
+        correct = [bool(c) for c in correct]
+        self._remember(key, correct)
+        if self.path is not None:
+            self.pending[key] = json.dumps(correct)
+
+    def flush(self):
+        """
+            Write the pending entries to the SQLite tier in one transaction.
+        """
+        if self.pending:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?)', self.pending.items())
+            self.pending.clear()
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+
+    def _remember(self, key, correct):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = correct
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'entries': len(self.entries)}
@@ -0,0 +1,30 @@
+"""
+    SQLite helpers shared by questions_store and score_cache.
+"""
+import os
+import sqlite3
+
+
+class ProcessConnection(object):
+    """
+        One sqlite3 connection per process. Connections must not cross a
+        fork, so a forked worker opens its own on first use.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+
+    def get(self):
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout)
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._pid = None